@@ -0,0 +1,148 @@
+from io import BytesIO
+from typing import Dict, Mapping, Optional
+import asyncio
+import hashlib
+import os
+import threading
+
+import aiohttp
+
+from cache import LRUCache
+
+
+AVATAR_SIZE = 204  # 0.2 of the render scale, in pixels
+PLACEHOLDER_COLOR = (76, 86, 106)
+
+
+# PIL is imported where it is used, so importing this module at startup
+# doesn't load it before the first avatar is downloaded
+
+
+def circle(image):
+    import resources
+
+    image = image.convert("RGBA")
+    image.putalpha(resources.circle_mask(image.size[0]))
+    return image
+
+
+def encode(image) -> bytes:
+    with BytesIO() as output:
+        image.save(output, "PNG")
+        return output.getvalue()
+
+
+def prepare(content: bytes, size: int = AVATAR_SIZE) -> bytes:
+    """Decode a downloaded avatar and store it resized and circle-masked."""
+    from PIL import Image
+
+    image = Image.open(BytesIO(content)).convert("RGB").resize((size, size))
+    return encode(circle(image))
+
+
+def placeholder(size: int = AVATAR_SIZE) -> bytes:
+    from PIL import Image
+
+    return encode(circle(Image.new("RGB", (size, size), PLACEHOLDER_COLOR)))
+
+
+class AvatarCache:
+    """Downloads avatars concurrently and keeps them ready to paste.
+
+    Avatars are kept in memory and on disk, keyed by a hash of their url.
+    Discord puts the avatar hash in the url, so a changed avatar is a new key.
+    Once the directory holds more than max_files avatars, the ones least
+    recently read or written are deleted.
+    """
+
+    def __init__(self, directory=".avatars", size=AVATAR_SIZE, timeout=5, maxsize=512, connections=16, max_files=8192):
+        self.directory = directory
+        self.size = size
+        self.timeout = aiohttp.ClientTimeout(total=timeout)
+        self.connections = connections
+        self.memory = LRUCache(maxsize)
+        self.session = None
+        self._placeholder = None  # built on the first failed download
+        self.max_files = max_files
+        self.files = None  # avatars on disk, counted on the first store
+        self.files_lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, url: str) -> str:
+        key = hashlib.sha1(f"{self.size}:{url}".encode()).hexdigest()
+        return os.path.join(self.directory, f"{key}.png")
+
+    def _read(self, path: str) -> Optional[bytes]:
+        try:
+            with open(path, "rb") as file:
+                content = file.read()
+            os.utime(path)  # read recently, so pruned last
+            return content
+        except OSError:
+            return None
+
+    def _store(self, path: str, content: bytes) -> bytes:
+        prepared = prepare(content, self.size)
+        with open(path, "wb") as file:
+            file.write(prepared)
+        with self.files_lock:
+            if self.files is None:
+                self.files = len(os.listdir(self.directory))
+            else:
+                self.files += 1
+            if self.files > self.max_files:
+                self._prune()
+        return prepared
+
+    def _prune(self) -> None:
+        # Down to 90% of the limit, so the directory isn't listed on every store
+        entries = []
+        for entry in os.scandir(self.directory):
+            try:
+                entries.append((entry.stat().st_mtime, entry.path))
+            except OSError:
+                pass
+        entries.sort()
+        excess = len(entries) - self.max_files * 9 // 10
+        for _, path in entries[:max(excess, 0)]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        self.files = len(entries) - max(excess, 0)
+
+    async def fetch(self, url: str) -> bytes:
+        cached = self.memory.get(url)
+        if cached is not None:
+            return cached
+        path = self._path(url)
+        avatar = await asyncio.to_thread(self._read, path)
+        if avatar is None:
+            if self.session is None:
+                self.session = aiohttp.ClientSession(
+                    timeout=self.timeout,
+                    connector=aiohttp.TCPConnector(limit=self.connections),
+                )
+            try:
+                async with self.session.get(url) as response:
+                    response.raise_for_status()
+                    content = await response.read()
+                avatar = await asyncio.to_thread(self._store, path, content)
+            except (aiohttp.ClientError, asyncio.TimeoutError, OSError):
+                # Not cached, so the next render tries again
+                if self._placeholder is None:
+                    self._placeholder = placeholder(self.size)
+                return self._placeholder
+        self.memory.set(url, avatar)
+        return avatar
+
+    async def fetch_all(self, urls: Mapping[int, Optional[str]]) -> Dict[int, Optional[bytes]]:
+        """Map user ids to prepared avatars, or None for users without one."""
+        distinct = list({url for url in urls.values() if url})
+        fetched = dict(zip(distinct, await asyncio.gather(*(self.fetch(url) for url in distinct))))
+        return {id: fetched.get(url) for id, url in urls.items()}
+
+    async def close(self) -> None:
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
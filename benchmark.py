@@ -0,0 +1,221 @@
+"""Benchmarks for the tree pipeline on synthetic families.
+
+Runs without discord, firestore or the network:
+
+    python benchmark.py --sizes 100 1000 --shapes polycule lineage --output results.jsonl
+
+Every measurement is printed as one JSON object per line, so runs can be
+compared with any JSON tooling.
+"""
+from argparse import ArgumentParser
+import json
+import random
+import resource
+import sys
+import time
+import tracemalloc
+
+from database import Person
+from graph import Detail, FamilyGraph
+from memory import MemoryDatabase
+from snapshot import Snapshot, hydrate
+import visuals
+
+
+def polycule(size: int, rng: random.Random):
+    """One big partner network: everyone marries one or two earlier people."""
+    partners = {0: set()}
+    for id in range(1, size):
+        partners[id] = set()
+        for partner in rng.sample(range(id), min(id, rng.choice([1, 1, 2]))):
+            partners[id].add(partner)
+            partners[partner].add(id)
+    return {id: (sorted(p), []) for id, p in partners.items()}
+
+
+def lineage(size: int, rng: random.Random):
+    """Deep lineage: couples with one to three children, mostly continuing the line."""
+    people = {0: ([1], []), 1: ([0], [])}
+    couples = [(0, 1)]
+    next_id = 2
+    while next_id < size:
+        a, b = couples.pop(0) if len(couples) > 4 else couples[0]
+        for _ in range(rng.randint(1, 3)):
+            if next_id >= size:
+                break
+            people[a][1].append(next_id)
+            people[b][1].append(next_id)
+            people[next_id] = ([], [])
+            if next_id + 1 < size and rng.random() < 0.8:
+                people[next_id][0].append(next_id + 1)
+                people[next_id + 1] = ([next_id], [])
+                couples.append((next_id, next_id + 1))
+                next_id += 1
+            next_id += 1
+    return people
+
+
+def adoption(size: int, rng: random.Random):
+    """A few couples adopting almost everybody else."""
+    people = {id: ([], []) for id in range(size)}
+    parents = list(range(min(size, 6)))
+    for a, b in zip(parents[::2], parents[1::2]):
+        people[a][0].append(b)
+        people[b][0].append(a)
+    for child in range(len(parents), size):
+        for parent in rng.sample(parents, min(len(parents), 2)):
+            people[parent][1].append(child)
+    return people
+
+
+def cycles(size: int, rng: random.Random):
+    """Random parent/child edges, including cycles and people adopting relatives."""
+    people = {id: ([], []) for id in range(size)}
+    for child in range(size):
+        for parent in rng.sample(range(size), min(size, 2)):
+            if parent != child and child not in people[parent][1]:
+                people[parent][1].append(child)
+    return people
+
+
+def mixed(size: int, rng: random.Random):
+    """Lineages whose members also form small polycules across families."""
+    people = lineage(size, rng)
+    for _ in range(size // 10):
+        a, b = rng.sample(range(size), 2)
+        if b not in people[a][0]:
+            people[a][0].append(b)
+            people[b][0].append(a)
+    return people
+
+
+SHAPES = {
+    "polycule": polycule,
+    "lineage": lineage,
+    "adoption": adoption,
+    "cycles": cycles,
+    "mixed": mixed,
+}
+
+
+def generate(shape: str, size: int, seed=0) -> MemoryDatabase:
+    database = MemoryDatabase()
+    people = SHAPES[shape](size, random.Random(seed))
+    database.load(Person(id, database, partners, children) for id, (partners, children) in people.items())
+    return database
+
+
+class Stage:
+    """Times one stage, then runs it again to record its peak traced allocation.
+
+    tracemalloc slows every allocation down, so the timed run is untraced.
+    """
+
+    def __init__(self, records, **labels):
+        self.records = records
+        self.labels = labels
+
+    def __call__(self, stage, function, *args, **extra):
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        start = time.perf_counter()
+        result = function(*args)
+        seconds = time.perf_counter() - start
+        rss_growth = (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss) * 1024
+        tracemalloc.start()
+        try:
+            function(*args)
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        record = dict(self.labels, stage=stage, seconds=seconds, peak_bytes=peak,
+                      max_rss_growth_bytes=rss_growth, **extra)
+        self.records.append(record)
+        print(json.dumps(record), flush=True)
+        return result
+
+
+def run(shape: str, size: int, steps=2, repeat=1, render=True, layouts=("layered", "spring"), detail=None, snapshot=None, root=None):
+    """Benchmark a generated family, or the one in a snapshot file when given."""
+    records = []
+    if snapshot is None:
+        database = generate(shape, size)
+    else:
+        database = MemoryDatabase()
+        with Snapshot(snapshot) as people:
+            database.load(people.people(database))
+        size = len(database.people)
+    root = next(iter(database.people)) if root is None else root
+    for iteration in range(repeat):
+        stage = Stage(records, shape=shape, size=size, steps=steps, iteration=iteration)
+        stage("get_partner_ring", database.get_partner_ring, root)
+        graph = FamilyGraph(database)
+        stage("graph_load", graph.load)
+        if snapshot is not None:
+            stage("snapshot_hydrate", hydrate, FamilyGraph(database), snapshot)
+        generations_down, generations_up, partner_map, descendance_map, nodes, summaries = stage(
+            "calculate_generations", visuals.calculate_generations, graph, root, "both", steps, detail
+        )
+        generation_mapping = stage(
+            "calculate_generation_mapping", visuals.calculate_both_generation_mapping, generations_down, generations_up
+        )
+        links = stage("calculate_graph_like_object", visuals.calculate_graph_like_object, partner_map, descendance_map)
+        counts = {"nodes": len(generation_mapping), "edges": len(links)}
+        for layout in layouts:
+            if layout == "layered":
+                positions = stage(
+                    "layout_layered", visuals.calculate_layered_coordinates,
+                    links, generation_mapping, partner_map, root, "both", **counts
+                )
+            else:
+                nx_graph = visuals.calculate_nx_graph(links, nodes)
+                positions = stage("layout_spring", visuals.calculate_people_coordinates, nx_graph, root, **counts)
+        if render:
+            import rendering
+            from avatars import placeholder
+
+            avatar = placeholder()
+            avatar_map = {id: avatar for id in positions}
+            username_map = {id: f"user{id}#0000" for id in positions}
+            for id, summary in summaries.items():
+                avatar_map[id] = None
+                username_map[id] = summary.label
+            result = stage(
+                "render", rendering.render_tree,
+                positions, links, generation_mapping, avatar_map, username_map, "both", True, **counts
+            )
+            records[-1]["bytes"] = len(result.data)
+    return records
+
+
+def main(argv=None):
+    parser = ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[50, 200, 1000])
+    parser.add_argument("--shapes", nargs="+", choices=list(SHAPES), default=list(SHAPES))
+    parser.add_argument("--steps", type=int, default=2)
+    parser.add_argument("--repeat", type=int, default=1)
+    parser.add_argument("--layouts", nargs="+", choices=["layered", "spring"], default=["layered", "spring"])
+    parser.add_argument("--skip-render", action="store_true", help="skip drawing, e.g. without impact.ttf")
+    parser.add_argument("--node-budget", type=int, help="summarize people beyond this many nodes")
+    parser.add_argument("--snapshot", help="benchmark the family in this snapshot file instead of generated ones")
+    parser.add_argument("--root", type=int, help="person to draw the tree of, by default the first one")
+    parser.add_argument("--output", help="also write the records to this JSON lines file")
+    args = parser.parse_args(argv)
+
+    detail = args.node_budget and Detail(max_nodes=args.node_budget)
+    if args.snapshot:
+        records = run(
+            "snapshot", 0, args.steps, args.repeat, not args.skip_render, args.layouts, detail, args.snapshot, args.root
+        )
+    else:
+        records = []
+        for shape in args.shapes:
+            for size in args.sizes:
+                records += run(shape, size, args.steps, args.repeat, not args.skip_render, args.layouts, detail)
+    if args.output:
+        with open(args.output, "w") as output:
+            for record in records:
+                output.write(json.dumps(record) + "\n")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,38 +1,167 @@
-from distutils.log import debug
+from collections import Counter
 from io import BytesIO
-from firestore import FirestoreDatabase
+import asyncio
+import json
+from avatars import AvatarCache
+from cache import SingleFlight, VersionedCache
+from database import ThreadedDatabase
+from graph import Detail, FamilyGraph, kinship
+from layouts import LayoutStore
+from rendering import Budget, RenderPool
+from scheduler import Busy, Expired, Scheduler, Ticket
+from snapshot import Journal, checkpoint, hydrate
+from users import UserDirectory
 from discord.ext import commands
 import discord
-import visuals
+import metrics
 from dotenv import find_dotenv
 from dotenv import load_dotenv
+import logging
 import os
+import time
+
+
+logger = logging.getLogger(__name__)
+
+LAYOUTS = ["layered", "spring"]
+COMMANDS = {True: "descendants", False: "ancestors", None: "partners", "both": "tree"}
+INTERACTION_TTL = 15 * 60  # seconds an interaction accepts followups for
+ACTIVITY_KEYS = 4096  # trees counted for pre-warming before the rarest are dropped
+
+
+def ticket(interaction) -> Ticket:
+    return Ticket(interaction.user.id, interaction.guild_id, interaction.created_at.timestamp() + INTERACTION_TTL)
+
+
+def layout_tree(*args):
+    # visuals pulls in networkx and numpy, so it is only imported once the
+    # first tree is drawn rather than at startup
+    import visuals
+
+    return visuals.person_to_generations_and_coordinates(*args)
+
+
+def layout_path(*args):
+    import visuals
+
+    return visuals.calculate_path_coordinates(*args)
 
 
 class Fetcher:
-    def __init__(self, person, direction_children, builder):
+    def __init__(self, person, direction_children, builder, layout="layered", detail=None):
         self.person = person
         self.direction_children = direction_children
         self.builder = builder
+        self.layout = layout
+        self.detail = detail
 
     async def get_tree(self, ctx):
         await ctx.response.defer(invisible=False)
-        image, view = await self.builder.build_tree_and_view_for(
-            self.person, direction_children=self.direction_children
+        await self.builder.send_tree(
+            ctx.followup, ticket(ctx), self.person,
+            direction_children=self.direction_children, layout=self.layout, detail=self.detail,
         )
 
-        with BytesIO() as image_binary:
-            image.save(image_binary, "PNG")
-            image_binary.seek(0)
-            await ctx.followup.send(
-                file=discord.File(fp=image_binary, filename="tree.png"), view=view
-            )
-
 
 class MarriageCog(commands.Cog):
-    def __init__(self, bot, credentials_file="credentials.json"):
+    def __init__(self, bot, database, render_workers=None, render_budget=Budget(), image_cache_size=256, slow_command_seconds=5, detail=Detail(), prewarm=0, activity_file=".activity.json", snapshot=None, journal=None, render_concurrency=2, render_queue=32, snapshot_interval=None):
         self.bot = bot
-        self.database = FirestoreDatabase(credentials_file)
+        self.detail = detail
+        self.slow_command_seconds = slow_command_seconds
+        self.database = ThreadedDatabase(database)
+        self.graph = FamilyGraph(self.database.sync)
+        self.graph_lock = asyncio.Lock()
+        self.avatars = AvatarCache(os.getenv("AVATAR_CACHE_DIR", ".avatars"))
+        self.users = UserDirectory(bot)
+        # A worker per render the scheduler lets run at once; more would sit idle
+        self.renderer = RenderPool(render_workers or render_concurrency, render_budget)
+        self.images = VersionedCache(image_cache_size, ttl=600)
+        self.database.sync.subscribe(self.images.invalidate)
+        metrics.registry.collect("image_cache", self.images.stats)
+        self.renders = SingleFlight()
+        self.scheduler = Scheduler(render_concurrency, render_queue)
+        self.layouts = LayoutStore()
+        # Most requested trees, saved at shutdown and drawn again after the
+        # next login so their first request is served from cache
+        self.prewarm = prewarm
+        self.activity_file = activity_file
+        self.activity = Counter()
+        self.warming = None
+        # The graph is hydrated from a snapshot file when one exists, and the
+        # journal catches it up with changes made since it was written.
+        # Without a journal a snapshot goes stale, so it isn't used at all.
+        self.snapshot = snapshot if journal else None
+        self.journal = Journal(journal) if journal else None
+        self.snapshot_interval = snapshot_interval
+        self.checkpoints = None
+        if snapshot and not journal:
+            logger.warning("Ignoring SNAPSHOT_FILE without JOURNAL_FILE, as it would go stale")
+        if self.journal:
+            self.database.sync.subscribe(self.journal)
+
+    @commands.Cog.listener()
+    async def on_ready(self):
+        if self.prewarm and self.warming is None:
+            self.warming = asyncio.create_task(self.warm())
+        if self.snapshot and self.snapshot_interval and self.checkpoints is None:
+            self.checkpoints = asyncio.create_task(self.checkpoint_periodically())
+
+    async def warm(self):
+        start = asyncio.get_running_loop().time()
+        await asyncio.gather(self.family_graph(), self.renderer.warm())
+        try:
+            with open(self.activity_file) as file:
+                keys = json.load(file)[:self.prewarm]
+        except (OSError, ValueError):
+            keys = []
+        for id, direction_children, steps, legend, layout, detail in keys:
+            key = (id, direction_children, steps, legend, layout, Detail(*detail))
+            if self.images.get(key) is not None:
+                continue
+            try:
+                await self.renders.run(
+                    key, self.build_and_cache_image_for, key, id, steps, direction_children, legend, layout, key[5]
+                )
+            except Exception:
+                logger.exception("Could not pre-warm tree %s", key)
+        logger.info("Pre-warmed %d trees in %.1fs", len(keys), asyncio.get_running_loop().time() - start)
+
+    def save_activity(self):
+        if not self.prewarm:
+            return
+        with open(self.activity_file, "w") as file:
+            json.dump([key for key, _ in self.activity.most_common(self.prewarm)], file)
+
+    def checkpoint(self):
+        """Rewrite the snapshot from the graph and compact the journal."""
+        if not self.snapshot or not self.graph.loaded:
+            return
+        start = time.perf_counter()
+        count = checkpoint(self.graph, self.snapshot, self.journal)
+        logger.info("Wrote %d people to %s in %.1fs", count, self.snapshot, time.perf_counter() - start)
+
+    async def checkpoint_periodically(self):
+        while True:
+            await asyncio.sleep(self.snapshot_interval)
+            try:
+                await asyncio.to_thread(self.checkpoint)
+            except Exception:
+                logger.exception("Could not write snapshot %s", self.snapshot)
+
+    def cog_unload(self):
+        asyncio.create_task(self.avatars.close())
+        self.renderer.close()
+        self.database.sync.flush()
+
+    async def family_graph(self):
+        async with self.graph_lock:
+            if not self.graph.loaded:
+                if self.snapshot and os.path.exists(self.snapshot):
+                    replayed = await self.database.run(hydrate, self.graph, self.snapshot, self.journal.path)
+                    logger.info("Loaded graph from %s and replayed %d changes", self.snapshot, replayed)
+                else:
+                    await self.database.run(self.graph.load)
+        return self.graph
 
     @commands.slash_command(description="Marry a user")
     async def marry(self, ctx, partner: discord.User):
@@ -47,8 +176,8 @@ class MarriageCog(commands.Cog):
             await ctx.respond("You can't marry yourself", ephemeral=True)
             return
 
-        me = self.database.get_person(ctx.author.id)
-        target = self.database.get_person(partner.id)
+        me = await self.database.get_person(ctx.author.id)
+        target = await self.database.get_person(partner.id)
 
         if target.id in me.partners:
             await ctx.respond("You are already married", ephemeral=True)
@@ -64,7 +193,7 @@ class MarriageCog(commands.Cog):
                     "Sorry, we are not asking you -_-", ephemeral=True
                 )
                 return
-            me.add_partner(target)
+            await me.add_partner(target)
             await ctx.response.send_message(congrats_message)
 
         confirm_button = discord.ui.Button(
@@ -87,12 +216,12 @@ class MarriageCog(commands.Cog):
         await self._divorce(ctx, user)
 
     async def _divorce(self, ctx, partner: discord.User):
-        me = self.database.get_person(ctx.author.id)
-        target = self.database.get_person(partner.id)
+        me = await self.database.get_person(ctx.author.id)
+        target = await self.database.get_person(partner.id)
         if target.id not in me.partners:
             await ctx.respond("You are not married", ephemeral=True)
             return
-        me.remove_partner(target)
+        await me.remove_partner(target)
         await ctx.respond(f"{ctx.author.mention} divorced {partner.mention}")
 
     @commands.slash_command(description="Adopt a user")
@@ -108,8 +237,8 @@ class MarriageCog(commands.Cog):
             await ctx.respond("You can't adopt yourself", ephemeral=True)
             return
 
-        me = self.database.get_person(ctx.author.id)
-        target = self.database.get_person(child.id)
+        me = await self.database.get_person(ctx.author.id)
+        target = await self.database.get_person(child.id)
 
         if target.id in me.children:
             await ctx.respond("You are already their parent", ephemeral=True)
@@ -123,7 +252,7 @@ class MarriageCog(commands.Cog):
                     "Sorry, we are not asking you -_-", ephemeral=True
                 )
                 return
-            me.adopt(target)
+            await me.adopt(target)
             await ctx.response.send_message(congrats_message)
 
         confirm_button = discord.ui.Button(
@@ -141,12 +270,12 @@ class MarriageCog(commands.Cog):
         await self._disown(ctx, child)
 
     async def _disown(self, ctx, child: discord.User):
-        me = self.database.get_person(ctx.author.id)
-        target = self.database.get_person(child.id)
+        me = await self.database.get_person(ctx.author.id)
+        target = await self.database.get_person(child.id)
         if target.id not in me.children:
             await ctx.respond("They are not your child", ephemeral=True)
             return
-        me.disown(target)
+        await me.disown(target)
         await ctx.respond(f"{child.mention}, {ctx.author.mention} disowned you")
 
     @commands.slash_command(description="Make a user your parent")
@@ -162,8 +291,8 @@ class MarriageCog(commands.Cog):
             await ctx.respond("You can't be your own parent", ephemeral=True)
             return
 
-        me = self.database.get_person(ctx.author.id)
-        target = self.database.get_person(parent.id)
+        me = await self.database.get_person(ctx.author.id)
+        target = await self.database.get_person(parent.id)
 
         if me.id in target.children:
             await ctx.respond("You are already their child", ephemeral=True)
@@ -177,7 +306,7 @@ class MarriageCog(commands.Cog):
                     "Sorry, we are not asking you -_-", ephemeral=True
                 )
                 return
-            target.adopt(me)
+            await target.adopt(me)
             await ctx.response.send_message(congrats_message)
 
         confirm_button = discord.ui.Button(
@@ -196,121 +325,251 @@ class MarriageCog(commands.Cog):
         await self._runaway(ctx, parent)
 
     async def _runaway(self, ctx, parent: discord.User):
-        me = self.database.get_person(ctx.author.id)
-        target = self.database.get_person(parent.id)
+        me = await self.database.get_person(ctx.author.id)
+        target = await self.database.get_person(parent.id)
         if me.id not in target.children:
             await ctx.respond("You are not their child", ephemeral=True)
             return
-        target.disown(me)
+        await target.disown(me)
         await ctx.respond(f"{parent.mention}, {ctx.author.mention} ran away from you")
 
     @commands.user_command(name="Remove parent-child link")
     async def disown_user(self, ctx, user: discord.User):
-        me = self.database.get_person(ctx.author.id)
-        target = self.database.get_person(user.id)
+        me = await self.database.get_person(ctx.author.id)
+        target = await self.database.get_person(user.id)
         if me.id in target.children:
-            target.disown(me)
+            await target.disown(me)
             await ctx.respond(f"{user.mention}, {ctx.author.mention} ran away from you")
         elif target.id in me.children:
-            me.disown(target)
+            await me.disown(target)
             await ctx.respond(f"{user.mention}, {ctx.author.mention} disowned you")
         else:
             await ctx.respond("You are not related in that way", ephemeral=True)
 
-    async def build_tree_for(self, id: int, steps=2, direction_children=True, legend=True):
-        generations, positions, links = visuals.person_to_generations_and_coordinates(
-            self.database.get_person(id), direction_children, steps,
-        )
-        profile_picture_map = {}
-        username_map = {}
-        for user_id in positions.keys():
-            user = await self.bot.fetch_user(user_id)
-            username_map[user_id] = f"{user.name}#{user.discriminator}"
-            profile_picture_map[user_id] = user.avatar and user.avatar.url
-        return (
-            visuals.render(
-                positions, links, generations, profile_picture_map, username_map, direction_children, legend
-            ),
-            generations,
+    async def build_tree_for(self, id: int, steps=2, direction_children=True, layout="layered", detail=None):
+        family_graph = await self.family_graph()
+        generations, positions, links, summaries = await asyncio.to_thread(
+            layout_tree,
+            family_graph, id, direction_children, steps, layout, detail, self.layouts,
         )
+        with metrics.span("fetch_users"):
+            users = await self.users.get_many([person for person in positions if person not in summaries])
+        username_map = {user_id: user.name for user_id, user in users.items()}
+        with metrics.span("fetch_avatars"):
+            avatar_map = await self.avatars.fetch_all(
+                {user_id: user.avatar_url for user_id, user in users.items()}
+            )
+        for summary_id, summary in summaries.items():
+            username_map[summary_id] = summary.label
+            avatar_map[summary_id] = None
+        return positions, links, generations, avatar_map, username_map, summaries
+
+    async def build_tree_and_view_for(self, id: int, steps=2, direction_children=True, legend=True, layout="layered", detail=None, ticket=None):
+        detail = detail or self.detail
+        with metrics.trace(COMMANDS[direction_children], self.slow_command_seconds):
+            key = (id, direction_children, steps, legend, layout, detail)
+            self.activity[key] += 1
+            limit = max(ACTIVITY_KEYS, 2 * self.prewarm)
+            if len(self.activity) > limit:
+                self.activity = Counter(dict(self.activity.most_common(limit // 2)))
+            cached = self.images.get(key)
+            metrics.count(image_cache_hits=cached is not None)
+            if cached is not None:
+                image, generations, summaries = cached
+            else:
+                # Identical requests arriving while this one renders share its result
+                image, generations, summaries = await self.renders.run(
+                    key, self.schedule_image_for, ticket, key, id, steps, direction_children, legend, layout, detail
+                )
+            with metrics.span("build_view"):
+                view = await self.build_view_for(generations, summaries, direction_children, layout, detail)
+            return image, view
+
+    async def send_tree(self, followup, ticket, *args, **kwargs):
+        try:
+            image, view = await self.build_tree_and_view_for(*args, ticket=ticket, **kwargs)
+        except Busy:
+            await followup.send("Too many trees are being drawn right now, try again in a minute", ephemeral=True)
+            return
+        except Expired:
+            logger.warning("Dropped a tree for %s that could not be sent in time", ticket.user)
+            return
+        with BytesIO(image.data) as image_binary:
+            await followup.send(
+                file=discord.File(fp=image_binary, filename=image.filename), view=view
+            )
 
-    async def build_tree_and_view_for(self, id: int, steps=2, direction_children=True, legend=True):
-        if direction_children == "both":
-            image_down, generations_down = await self.build_tree_for(id, steps, True, False)
-            image_up, generations_up = await self.build_tree_for(id, steps, False, False)
-            image, generations = visuals.merge_images(image_down, image_up, generations_down, generations_up)
-        else:
-            image, generations = await self.build_tree_for(id, steps, direction_children, legend)
+    async def schedule_image_for(self, ticket, key, *args):
+        # Renders are queued so a burst of requests can't exhaust memory;
+        # pre-warming has no ticket and runs one tree at a time anyway
+        if ticket is None:
+            return await self.build_and_cache_image_for(key, *args)
+        return await self.scheduler.run(ticket, self.build_and_cache_image_for, key, *args)
+
+    async def build_and_cache_image_for(self, key, *args):
+        since = self.images.clock
+        image, generations, summaries = await self.build_image_for(*args)
+        people = [person for person in generations if person not in summaries]
+        self.images.set(key, people, (image, generations, summaries), since)
+        return image, generations, summaries
+
+    async def build_image_for(self, id: int, steps=2, direction_children=True, legend=True, layout="layered", detail=None):
+        *tree, summaries = await self.build_tree_for(id, steps, direction_children, layout, detail)
+        # Both directions are drawn on one canvas, which always needs a legend
+        legend = legend or direction_children == "both"
+        with metrics.span("render"):
+            image = await self.renderer.render_tree(*tree, direction_children, legend)
+        metrics.record("render.draw", image.stats["draw_seconds"])
+        metrics.record("render.encode", image.stats["encode_seconds"])
+        metrics.count(bytes_encoded=image.stats["bytes"])
+        generations = tree[2]
+        logger.info("Rendered tree for %s: %s", id, image.stats)
+        return image, generations, summaries
+
+    async def build_view_for(self, generations, summaries, direction_children=True, layout="layered", detail=None):
         buttons = []
-        for person, gendata in generations.items():
-            allowed = False
-            for direct, generation in gendata:
-                if generation == 1:
-                    allowed = True
-            if not allowed:
-                continue
-            user = await self.bot.fetch_user(person)
+        allowed = [
+            person for person, gendata in generations.items()
+            if person not in summaries and any(abs(generation) == 1 for direct, generation in gendata)
+        ]
+        users = await self.users.get_many(allowed)
+        for person in allowed:
             button = discord.ui.Button(
-                label=f"{user.name}#{user.discriminator}",
+                label=users[person].name,
             )
-            button.callback = Fetcher(person, direction_children, self).get_tree
+            button.callback = Fetcher(person, direction_children, self, layout, detail).get_tree
+            buttons.append(button)
+        # Summary nodes expand into the anchor's tree with twice the configured
+        # budget, never more, however many times a summary is expanded
+        expanded = Detail(*(limit * 2 for limit in self.detail))
+        for summary in summaries.values():
+            button = discord.ui.Button(
+                label=f"{summary.label} of {users[summary.anchor].name}"
+                if summary.anchor in users else summary.label,
+                style=discord.ButtonStyle.secondary,
+            )
+            button.callback = Fetcher(summary.anchor, direction_children, self, layout, expanded).get_tree
             buttons.append(button)
 
-        view = discord.ui.View(*buttons)
-        return image, view
+        # A message holds at most 25 components, so relatives come first
+        return discord.ui.View(*buttons[:25])
 
     @commands.slash_command(description="Show your descendants tree")
-    async def descendants(self, ctx, person: discord.User = None, generations: int = 2):
+    async def descendants(self, ctx, person: discord.User = None, generations: int = 2, layout: discord.Option(str, choices=LAYOUTS) = "layered"):
         await ctx.defer()
-        image, view = await self.build_tree_and_view_for(ctx.author.id if person is None else person.id, generations)
-        with BytesIO() as image_binary:
-            image.save(image_binary, "PNG")
-            image_binary.seek(0)
-            await ctx.followup.send(
-                file=discord.File(fp=image_binary, filename="tree.png"), view=view
-            )
+        await self.send_tree(ctx.followup, ticket(ctx.interaction), ctx.author.id if person is None else person.id, generations, layout=layout)
 
     @commands.slash_command(description="Show your ancestors tree")
-    async def ancestors(self, ctx, person: discord.User = None, generations: int = 2):
+    async def ancestors(self, ctx, person: discord.User = None, generations: int = 2, layout: discord.Option(str, choices=LAYOUTS) = "layered"):
         await ctx.defer()
-        image, view = await self.build_tree_and_view_for(ctx.author.id if person is None else person.id, generations, False)
-        with BytesIO() as image_binary:
-            image.save(image_binary, "PNG")
-            image_binary.seek(0)
-            await ctx.followup.send(
-                file=discord.File(fp=image_binary, filename="tree.png"), view=view
-            )
+        await self.send_tree(ctx.followup, ticket(ctx.interaction), ctx.author.id if person is None else person.id, generations, False, layout=layout)
 
     @commands.slash_command(description="Show your partner tree")
-    async def partners(self, ctx, person: discord.User = None):
+    async def partners(self, ctx, person: discord.User = None, layout: discord.Option(str, choices=LAYOUTS) = "layered"):
         await ctx.defer()
-        image, view = await self.build_tree_and_view_for(ctx.author.id if person is None else person.id, 0, None, False)
-        with BytesIO() as image_binary:
-            image.save(image_binary, "PNG")
-            image_binary.seek(0)
-            await ctx.followup.send(
-                file=discord.File(fp=image_binary, filename="tree.png"), view=view
-            )
+        await self.send_tree(ctx.followup, ticket(ctx.interaction), ctx.author.id if person is None else person.id, 0, None, False, layout=layout)
 
     @commands.slash_command(description="Show your family tree")
-    async def tree(self, ctx, person: discord.User = None, generations: int = 2):
+    async def tree(self, ctx, person: discord.User = None, generations: int = 2, layout: discord.Option(str, choices=LAYOUTS) = "layered"):
         await ctx.defer()
-        image, view = await self.build_tree_and_view_for(ctx.author.id if person is None else person.id, generations, "both", False)
-        with BytesIO() as image_binary:
-            image.save(image_binary, "PNG")
-            image_binary.seek(0)
-            await ctx.followup.send(
-                file=discord.File(fp=image_binary, filename="tree.png"), view=view
-            )
+        await self.send_tree(ctx.followup, ticket(ctx.interaction), ctx.author.id if person is None else person.id, generations, "both", False, layout=layout)
+
+    @commands.slash_command(description="Show how two users are related")
+    async def relationship(self, ctx, user_a: discord.User, user_b: discord.User, image: bool = False):
+        await ctx.defer()
+        with metrics.trace("relationship", self.slow_command_seconds):
+            family_graph = await self.family_graph()
+            with metrics.span("search"):
+                path = await asyncio.to_thread(family_graph.relationship, user_a.id, user_b.id)
+        if path is None:
+            await ctx.followup.send(f"{user_a.mention} and {user_b.mention} are not closely related")
+            return
+        if not path:
+            await ctx.followup.send(f"{user_a.mention} and {user_b.mention} are the same person")
+            return
+        text = f"{user_b.mention} is the {kinship(path)} of {user_a.mention}"
+        if not image:
+            await ctx.followup.send(text)
+            return
+        try:
+            result = await self.scheduler.run(ticket(ctx.interaction), self.build_path_image_for, user_a.id, path)
+        except (Busy, Expired):
+            await ctx.followup.send(text)
+            return
+        with BytesIO(result.data) as image_binary:
+            await ctx.followup.send(text, file=discord.File(fp=image_binary, filename=result.filename))
+
+    async def build_path_image_for(self, id: int, path):
+        people = [id] + [person for _, person in path]
+        generations = [0]
+        for relation, _ in path:
+            generations.append(generations[-1] + {"parent": -1, "child": 1, "partner": 0}[relation])
+        positions = await asyncio.to_thread(layout_path, people, generations)
+        links = [(a, b) if a < b else (b, a) for a, b in zip(people, people[1:])]
+        generation_mapping = {person: [(True, generation)] for person, generation in zip(people, generations)}
+        users = await self.users.get_many(people)
+        avatar_map = await self.avatars.fetch_all({user_id: user.avatar_url for user_id, user in users.items()})
+        username_map = {user_id: user.name for user_id, user in users.items()}
+        return await self.renderer.render_tree(positions, links, generation_mapping, avatar_map, username_map, "both", True)
+
+
+def open_database():
+    # Only import the backend in use, so a SQLite deployment needs no firebase
+    sqlite_path = os.getenv("SQLITE_DATABASE")
+    if sqlite_path:
+        from sqlite import SqliteDatabase
+
+        return SqliteDatabase(sqlite_path)
+
+    from firestore import FirestoreDatabase
+
+    cache_ttl = os.getenv("CACHE_TTL")
+    return FirestoreDatabase(
+        cache_size=int(os.getenv("CACHE_SIZE", 4096)),
+        cache_ttl=cache_ttl and float(cache_ttl),
+        watch=bool(os.getenv("FIRESTORE_WATCH")),
+        write_behind=float(os.getenv("WRITE_BEHIND", 0)),
+    )
 
 
 def main():
     load_dotenv(find_dotenv(usecwd=True))
+    logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO"))
     bot = commands.Bot(
         command_prefix=commands.when_mentioned
     )
-    bot.add_cog(MarriageCog(bot))
-    bot.run(os.getenv("TOKEN"))
+    render_workers = os.getenv("RENDER_WORKERS")
+    budget = Budget()
+    cog = MarriageCog(
+        bot,
+        open_database(),
+        render_workers=render_workers and int(render_workers),
+        render_budget=Budget(
+            max_pixels=int(os.getenv("RENDER_MAX_PIXELS", budget.max_pixels)),
+            max_side=int(os.getenv("RENDER_MAX_SIDE", budget.max_side)),
+            max_bytes=int(os.getenv("RENDER_MAX_BYTES", budget.max_bytes)),
+        ),
+        slow_command_seconds=float(os.getenv("SLOW_COMMAND_SECONDS", 5)),
+        detail=Detail(max_nodes=int(os.getenv("NODE_BUDGET", Detail().max_nodes))),
+        prewarm=int(os.getenv("PREWARM_TREES", 0)),
+        activity_file=os.getenv("ACTIVITY_FILE", ".activity.json"),
+        snapshot=os.getenv("SNAPSHOT_FILE"),
+        journal=os.getenv("JOURNAL_FILE"),
+        render_concurrency=int(os.getenv("RENDER_CONCURRENCY", 2)),
+        render_queue=int(os.getenv("RENDER_QUEUE", 32)),
+        snapshot_interval=float(os.getenv("SNAPSHOT_INTERVAL", 6 * 60 * 60)),
+    )
+    bot.add_cog(cog)
+    if os.getenv("METRICS_PORT"):
+        metrics.serve(int(os.getenv("METRICS_PORT")))
+    if os.getenv("METRICS_LOG_INTERVAL"):
+        bot.loop.create_task(metrics.log_periodically(float(os.getenv("METRICS_LOG_INTERVAL"))))
+    try:
+        bot.run(os.getenv("TOKEN"))
+    finally:
+        cog.database.sync.flush()
+        cog.save_activity()
+        cog.checkpoint()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,155 @@
+from collections import OrderedDict
+from threading import Lock
+import asyncio
+from typing import Any, Hashable, Iterable, Optional
+import time
+
+
+_MISSING = object()
+
+
+class LRUCache:
+    """Size-bounded least-recently-used mapping with an optional time to live.
+
+    All operations are guarded by a lock, so one instance can be shared
+    between the event loop and worker threads.
+    """
+
+    def __init__(self, maxsize: int = 4096, ttl: Optional[float] = None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data = OrderedDict()  # key -> (expires, value)
+        self._lock = Lock()
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            entry = self._data.get(key, _MISSING)
+            if entry is not _MISSING and entry[0] is not None and entry[0] < time.monotonic():
+                del self._data[key]
+                self.evictions += 1
+                entry = _MISSING
+            if entry is _MISSING:
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key: Hashable, value: Any) -> None:
+        expires = None if self.ttl is None else time.monotonic() + self.ttl
+        with self._lock:
+            self._data[key] = (expires, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def pop(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            entry = self._data.pop(key, _MISSING)
+        return default if entry is _MISSING else entry[1]
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+    def __contains__(self, key: Hashable) -> bool:
+        with self._lock:
+            entry = self._data.get(key, _MISSING)
+            return entry is not _MISSING and (entry[0] is None or entry[0] >= time.monotonic())
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def stats(self) -> dict:
+        return {
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+
+class VersionedCache:
+    """Cache of values computed from a set of people.
+
+    Every stored value remembers the version of each person it was built
+    from. Changing a person bumps their version, which makes exactly the
+    entries built from them stale.
+    """
+
+    def __init__(self, maxsize: int = 256, ttl: Optional[float] = None):
+        self.entries = LRUCache(maxsize, ttl)
+        self.versions = {}  # id -> clock value of the last change
+        self.clock = 0
+        self.hits = 0
+        self.misses = 0
+        # Changes are notified from worker and firestore watch threads
+        self._lock = Lock()
+
+    def invalidate(self, person) -> None:
+        # The person's relatives are bumped too: adopting someone only saves
+        # the parent, but changes the child's ancestors
+        with self._lock:
+            self.clock += 1
+            for id in {person.id, *person.partners, *person.children}:
+                self.versions[id] = self.clock
+
+    def _stamp(self, people: Iterable[int]) -> tuple:
+        with self._lock:
+            return tuple(sorted((id, self.versions.get(id, 0)) for id in people))
+
+    def get(self, key: Hashable) -> Any:
+        entry = self.entries.get(key)
+        if entry is not None and entry[0] == self._stamp(id for id, _ in entry[0]):
+            self.hits += 1
+            return entry[1]
+        if entry is not None:
+            self.entries.pop(key)
+        self.misses += 1
+        return None
+
+    def set(self, key: Hashable, people: Iterable[int], value: Any, since: Optional[int] = None) -> None:
+        """Store a value built from `people`.
+
+        Pass the clock read before the value was computed as `since`, so a
+        value that raced with a change to one of its people is dropped.
+        """
+        stamp = self._stamp(people)
+        if since is not None and any(version > since for _, version in stamp):
+            return
+        self.entries.set(key, (stamp, value))
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self.entries),
+            "maxsize": self.entries.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "evictions": self.entries.evictions,
+        }
+
+
+class SingleFlight:
+    """Shares one in-flight call between concurrent callers with the same key."""
+
+    def __init__(self):
+        self.calls = {}
+        self.shared = 0
+
+    async def run(self, key: Hashable, function, *args) -> Any:
+        future = self.calls.get(key)
+        if future is None:
+            future = asyncio.ensure_future(function(*args))
+            self.calls[key] = future
+            future.add_done_callback(lambda _: self.calls.pop(key, None))
+        else:
+            self.shared += 1
+        # Shielded, so a caller giving up does not cancel the others' result
+        return await asyncio.shield(future)
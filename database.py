@@ -1,6 +1,9 @@
 from abc import ABC, abstractmethod
+import asyncio
 from dataclasses import dataclass, field
-from typing import List, Mapping, Tuple
+from typing import Iterable, List, Mapping, Tuple
+
+import metrics
 
 
 @dataclass
@@ -10,31 +13,43 @@ class Person:
     partners: list[int] = field(default_factory=list)
     children: list[int] = field(default_factory=list)
 
+    def copy(self, database: "Database" = None) -> "Person":
+        return Person(
+            id=self.id,
+            database=self.database if database is None else database,
+            partners=list(self.partners),
+            children=list(self.children),
+        )
+
     def dump(self):
         self.database.save_person(self)
     
     def add_partner(self, person: "Person"):
         self.partners.append(person.id)
         person.partners.append(self.id)
-        self.dump()
-        person.dump()
+        self.database.commit([
+            Change(self, "partners", added=[person.id]),
+            Change(person, "partners", added=[self.id]),
+        ])
     
     def remove_partner(self, person: "Person"):
         self.partners.remove(person.id)
         person.partners.remove(self.id)
-        self.dump()
-        person.dump()
+        self.database.commit([
+            Change(self, "partners", removed=[person.id]),
+            Change(person, "partners", removed=[self.id]),
+        ])
     
     def adopt(self, person: "Person"):
         self.children.append(person.id)
-        self.dump()
+        self.database.commit([Change(self, "children", added=[person.id])])
     
     def disown(self, person: "Person"):
         self.children.remove(person.id)
-        self.dump()
+        self.database.commit([Change(self, "children", removed=[person.id])])
     
     def get_children(self):
-        return [self.database.get_person(child) for child in self.children]
+        return self.database.get_people(self.children)
     
     def get_parents(self):
         return self.database.get_parents(self.id)
@@ -42,36 +57,216 @@ class Person:
     def get_partners(self):
         return self.database.get_partners(self.id)
 
+@dataclass
+class Change:
+    """Ids added to or removed from one list field of a person.
+
+    `person` says who changed. Its lists may have been read long before the
+    change is committed, e.g. when a proposal is accepted, so backends and
+    caches apply only `added` and `removed`.
+    """
+    person: Person
+    attribute: str  # "partners" or "children"
+    added: list[int] = field(default_factory=list)
+    removed: list[int] = field(default_factory=list)
+
+
+def apply(person, changes: Iterable[Change]):
+    """Return a copy of a Person or AsyncPerson with their changes applied."""
+    person = type(person)(person.id, person.database, list(person.partners), list(person.children))
+    for change in changes:
+        if change.person.id != person.id:
+            continue
+        values = getattr(person, change.attribute)
+        for value in change.added:
+            if value not in values:
+                values.append(value)
+        for value in change.removed:
+            while value in values:
+                values.remove(value)
+    return person
+
+
 class Database(ABC):
+    def __init__(self):
+        self.listeners = []
+
+    def subscribe(self, listener) -> None:
+        """Call `listener(person)` whenever a person is saved or changes."""
+        self.listeners.append(listener)
+
+    def _notify(self, person: Person) -> None:
+        for listener in self.listeners:
+            listener(person)
+
     @abstractmethod
     def get_person(self, id: int) -> Person:
         pass
 
+    def get_people(self, ids: Iterable[int]) -> List[Person]:
+        return [self.get_person(id) for id in ids]
+
     @abstractmethod
     def save_person(self, person: Person) -> None:
         pass
 
+    def commit(self, changes: List[Change]) -> None:
+        """Apply every change at once; backends that can should do it atomically."""
+        for id in dict.fromkeys(change.person.id for change in changes):
+            self.save_person(apply(self.get_person(id), changes))
+
+    def flush(self) -> None:
+        """Write out anything a backend buffered, e.g. before shutting down."""
+
     @abstractmethod
     def get_parents(self, id: int) -> List[Person]:
         pass
 
-    def get_partner_ring(self, person: int, initial: List[int] = []) -> Tuple[Mapping[int, List[int]], List[int]]:
-        output = initial + [person]
+    @abstractmethod
+    def all_people(self) -> Iterable[Person]:
+        pass
+
+    def get_partner_ring(self, person: int) -> Tuple[Mapping[int, List[int]], List[int]]:
         map = {}
-        immediate = self.get_person(person).partners
-        map[person] = immediate
-        for partner in immediate:
-            if partner not in initial:
-                output.append(partner)
-                map_partner, distant = self.get_partner_ring(partner, output)
-                output += distant
-                map[partner] = distant
-                for a, b in map_partner.items():
-                    map[a] = b
-        return map, list(set(output))
-
-    def get_partners(self, id: int) -> Mapping[Person, List[Person]]:
+        frontier = [person]
+        while frontier:
+            for found in self.get_people(frontier):
+                map[found.id] = found.partners
+            frontier = list({
+                partner for id in frontier for partner in map[id] if partner not in map
+            })
+        return map, list(map.keys())
+
+    def get_partners(self, id: int) -> Tuple[Mapping[int, List[Person]], List[Person]]:
         map, ring = self.get_partner_ring(id)
+        people = {person.id: person for person in self.get_people(ring)}
+        return {
+            id: [people[partner] for partner in partners] for id, partners in map.items()
+        }, [people[id] for id in ring]
+
+
+@dataclass
+class AsyncPerson:
+    id: int
+    database: "AsyncDatabase"
+    partners: list[int] = field(default_factory=list)
+    children: list[int] = field(default_factory=list)
+
+    async def dump(self):
+        await self.database.save_person(self)
+
+    async def add_partner(self, person: "AsyncPerson"):
+        self.partners.append(person.id)
+        person.partners.append(self.id)
+        await self.database.commit([
+            Change(self, "partners", added=[person.id]),
+            Change(person, "partners", added=[self.id]),
+        ])
+
+    async def remove_partner(self, person: "AsyncPerson"):
+        self.partners.remove(person.id)
+        person.partners.remove(self.id)
+        await self.database.commit([
+            Change(self, "partners", removed=[person.id]),
+            Change(person, "partners", removed=[self.id]),
+        ])
+
+    async def adopt(self, person: "AsyncPerson"):
+        self.children.append(person.id)
+        await self.database.commit([Change(self, "children", added=[person.id])])
+
+    async def disown(self, person: "AsyncPerson"):
+        self.children.remove(person.id)
+        await self.database.commit([Change(self, "children", removed=[person.id])])
+
+    async def get_children(self):
+        return await self.database.get_people(self.children)
+
+    async def get_parents(self):
+        return await self.database.get_parents(self.id)
+
+    async def get_partners(self):
+        return await self.database.get_partners(self.id)
+
+
+class AsyncDatabase(ABC):
+    @abstractmethod
+    async def get_person(self, id: int) -> AsyncPerson:
+        pass
+
+    async def get_people(self, ids: Iterable[int]) -> List[AsyncPerson]:
+        return list(await asyncio.gather(*(self.get_person(id) for id in ids)))
+
+    @abstractmethod
+    async def save_person(self, person: AsyncPerson) -> None:
+        pass
+
+    async def commit(self, changes: List[Change]) -> None:
+        for id in dict.fromkeys(change.person.id for change in changes):
+            await self.save_person(apply(await self.get_person(id), changes))
+
+    @abstractmethod
+    async def get_parents(self, id: int) -> List[AsyncPerson]:
+        pass
+
+    async def get_partner_ring(self, person: int) -> Tuple[Mapping[int, List[int]], List[int]]:
+        map = {}
+        frontier = [person]
+        while frontier:
+            for found in await self.get_people(frontier):
+                map[found.id] = found.partners
+            frontier = list({
+                partner for id in frontier for partner in map[id] if partner not in map
+            })
+        return map, list(map.keys())
+
+    async def get_partners(self, id: int) -> Tuple[Mapping[int, List[AsyncPerson]], List[AsyncPerson]]:
+        map, ring = await self.get_partner_ring(id)
+        people = {person.id: person for person in await self.get_people(ring)}
+        return {
+            id: [people[partner] for partner in partners] for id, partners in map.items()
+        }, [people[id] for id in ring]
+
+
+class ThreadedDatabase(AsyncDatabase):
+    """Runs a synchronous Database in worker threads, off the event loop."""
+
+    def __init__(self, database: Database):
+        self.sync = database
+
+    async def run(self, function, *args, **kwargs):
+        with metrics.span(f"storage.{function.__name__}"):
+            return await asyncio.to_thread(function, *args, **kwargs)
+
+    def _wrap(self, person: Person) -> AsyncPerson:
+        return AsyncPerson(person.id, self, list(person.partners), list(person.children))
+
+    async def get_person(self, id: int) -> AsyncPerson:
+        return self._wrap(await self.run(self.sync.get_person, id))
+
+    async def get_people(self, ids: Iterable[int]) -> List[AsyncPerson]:
+        return [self._wrap(person) for person in await self.run(self.sync.get_people, list(ids))]
+
+    async def save_person(self, person: AsyncPerson) -> None:
+        await self.run(self.sync.save_person, self._unwrap(person))
+
+    def _unwrap(self, person: AsyncPerson) -> Person:
+        return Person(person.id, self.sync, list(person.partners), list(person.children))
+
+    async def commit(self, changes: List[Change]) -> None:
+        await self.run(self.sync.commit, [
+            Change(self._unwrap(change.person), change.attribute, change.added, change.removed)
+            for change in changes
+        ])
+
+    async def get_parents(self, id: int) -> List[AsyncPerson]:
+        return [self._wrap(person) for person in await self.run(self.sync.get_parents, id)]
+
+    async def get_partner_ring(self, person: int) -> Tuple[Mapping[int, List[int]], List[int]]:
+        return await self.run(self.sync.get_partner_ring, person)
+
+    async def get_partners(self, id: int) -> Tuple[Mapping[int, List[AsyncPerson]], List[AsyncPerson]]:
+        map, people = await self.run(self.sync.get_partners, id)
         return {
-            id: [self.get_person(partner) for partner in partners] for id, partners in map.items()
-        }, [self.get_person(id) for id in map.keys()]
+            id: [self._wrap(partner) for partner in partners] for id, partners in map.items()
+        }, [self._wrap(person) for person in people]
@@ -1,50 +1,263 @@
 from dataclasses import asdict
-from typing import Iterable, List
+from threading import Lock, Timer
+from typing import Dict, Iterable, List, Tuple
 import firebase_admin
 from firebase_admin import credentials
 from firebase_admin import firestore
+from firebase_admin import firestore_async
 
+from cache import LRUCache
+import metrics
+from database import AsyncDatabase
+from database import AsyncPerson
+from database import Change
 from database import Person
 from database import Database
+from database import apply
+
+
+# BATCH_LIMIT is the maximum number of writes firestore accepts in one batch
+BATCH_LIMIT = 500
+
+Pending = Dict[Tuple[int, str], Dict[int, bool]]  # (id, attribute) -> {value: added}
+
+
+def coalesce(pending: Pending, changes: Iterable[Change]) -> Pending:
+    """Fold changes into pending deltas; the last operation on a value wins."""
+    for change in changes:
+        operations = pending.setdefault((change.person.id, change.attribute), {})
+        for value in change.added:
+            operations[value] = True
+        for value in change.removed:
+            operations[value] = False
+    return pending
+
+
+def delta_writes(pending: Pending):
+    """Yield (id, data) pairs for set(..., merge=True) with array deltas."""
+    for (id, attribute), operations in pending.items():
+        added = [str(value) for value, is_added in operations.items() if is_added]
+        removed = [str(value) for value, is_added in operations.items() if not is_added]
+        if added:
+            yield id, {attribute: firestore.ArrayUnion(added)}
+        if removed:
+            yield id, {attribute: firestore.ArrayRemove(removed)}
 
 
 class FirestoreConnector:
-    def __init__(self, credentials_file="credentials.json"):
-        self.cred = credentials.Certificate(credentials_file)
+    def __init__(self, credentials_file="credentials.json", cache_size=4096, cache_ttl=None, watch=False, write_behind=0):
+        self.credentials_file = credentials_file
+        self._db = None
+        self.connect_lock = Lock()
+        self.cache = LRUCache(cache_size, cache_ttl)
+        self.on_change = None
+        # With write_behind set, changes are buffered for that many seconds
+        # and bursts to the same person are coalesced into one write
+        self.write_behind = write_behind
+        self.pending = {}
+        self.writing = []  # pending deltas that flushes are writing right now
+        self.pending_lock = Lock()
+        self.timer = None
+        self.watch_changes = watch
+        self.watch = None
+        self.watch_primed = False
+
+    @property
+    def db(self):
+        # The app is initialized on first use rather than at startup, so the
+        # bot can log in while firebase is still connecting
+        if self._db is None:
+            with self.connect_lock:
+                if self._db is None:
+                    self._connect()
+        return self._db
+
+    def _connect(self) -> None:
+        self.cred = credentials.Certificate(self.credentials_file)
         firebase_admin.initialize_app(self.cred)
+        db = firestore.client()
+        if self.watch_changes:
+            # Keeps several replicas coherent: any change to a document evicts
+            # it, so the next read goes back to firestore
+            self.watch = db.collection("people").on_snapshot(self._on_snapshot)
+        self._db = db
+
+    def _on_snapshot(self, snapshot, changes, read_time):
+        # The first callback lists every existing document as added, which
+        # says nothing about what changed
+        if not self.watch_primed:
+            self.watch_primed = True
+            return
+        for change in changes:
+            id = int(change.document.id)
+            self.cache.pop(id)
+            if self.on_change is not None:
+                # The echo of one flush lacks whatever was queued since
+                person = self.from_dict(change.document.to_dict(), id, None)
+                self.on_change(apply(person, self._queued([id], None)))
 
-        self.db = firestore.client()
-        self.cache = {}
+    def _cached(self, id: int, database: Database):
+        cached = self.cache.get(id)
+        metrics.count(cache_hits=cached is not None, cache_misses=cached is None)
+        return None if cached is None else cached.copy(database)
+
+    def _store(self, person: Person) -> None:
+        self.cache.set(person.id, person.copy())
 
     def get_person(self, id: int, database: Database) -> Person:
-        cached = self.cache.get(id, None)
+        cached = self._cached(id, database)
         if cached is not None:
             return cached
-        doc_ref = self.db.collection("people").document(str(id))
-        doc = doc_ref.get()
-        person =  self.from_dict(doc.to_dict(), id, database)
-        self.cache[id] = person
+        person = self._read(id, database)
+        self._store(person)
         return person
 
+    def get_people(self, ids: Iterable[int], database: Database) -> List[Person]:
+        ids = list(ids)
+        people = {}
+        for id in set(ids):
+            cached = self._cached(id, database)
+            if cached is not None:
+                people[id] = cached
+        missing = [id for id in set(ids) if id not in people]
+        if missing:
+            queued = self._queued(missing, database)
+            metrics.count(db_reads=len(missing))
+            doc_refs = [self.db.collection("people").document(str(id)) for id in missing]
+            for doc in self.db.get_all(doc_refs):
+                person = apply(self.from_dict(doc.to_dict(), doc.id, database), queued)
+                self._store(person)
+                people[person.id] = person
+        return [people[id] for id in ids]
+
     def set_person(self, id, person: Person) -> None:
         doc_ref = self.db.collection("people").document(str(id))
         doc_ref.set(self._prepare(person))
-        self.cache[id] = person
+        self._store(person)
+
+    def commit(self, changes: List[Change], database: Database) -> List[Person]:
+        """Write the deltas and return everyone changed, as now stored.
+
+        The changes' people may be stale, so cached copies only get the
+        deltas, and only once they were written or queued by write_behind.
+        """
+        ids = list(dict.fromkeys(change.person.id for change in changes))
+        if not self.write_behind:
+            self._write(coalesce({}, changes))
+        else:
+            with self.pending_lock:
+                coalesce(self.pending, changes)
+                if self.timer is None:
+                    self.timer = Timer(self.write_behind, self.flush)
+                    self.timer.daemon = True
+                    self.timer.start()
+        people = []
+        for id in ids:
+            cached = self._cached(id, database)
+            person = apply(cached, changes) if cached is not None else self._read(id, database)
+            self._store(person)
+            people.append(person)
+        return people
+
+    @staticmethod
+    def _split(operations: Dict[int, bool]) -> Tuple[List[int], List[int]]:
+        added = [value for value, is_added in operations.items() if is_added]
+        return added, [value for value, is_added in operations.items() if not is_added]
+
+    def _queued(self, ids: Iterable[int], database: Database) -> List[Change]:
+        """Deltas of these people that write_behind has not stored yet."""
+        ids = set(ids)
+        with self.pending_lock:
+            return [
+                Change(Person(id, database), attribute, *self._split(operations))
+                for pending in (*self.writing, self.pending)
+                for (id, attribute), operations in pending.items() if id in ids
+            ]
+
+    def _read(self, id: int, database: Database) -> Person:
+        # Taken before reading: deltas that land in between are applied twice,
+        # which changes nothing, instead of not at all
+        queued = self._queued([id], database)
+        doc = self.db.collection("people").document(str(id)).get()
+        metrics.count(db_reads=1)
+        return apply(self.from_dict(doc.to_dict(), id, database), queued)
+
+    def flush(self) -> None:
+        with self.pending_lock:
+            pending, self.pending = self.pending, {}
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+            if not pending:
+                return
+            self.writing.append(pending)
+        try:
+            self._write(pending)
+        finally:
+            with self.pending_lock:
+                self.writing.remove(pending)
+
+    def _write(self, pending: Pending) -> None:
+        # One batch is atomic; only a burst of more than BATCH_LIMIT writes
+        # gets split over several
+        batch = self.db.batch()
+        size = 0
+        for id, data in delta_writes(pending):
+            batch.set(self.db.collection("people").document(str(id)), data, merge=True)
+            metrics.count(db_writes=1)
+            size += 1
+            if size == BATCH_LIMIT:
+                batch.commit()
+                batch = self.db.batch()
+                size = 0
+        if size:
+            batch.commit()
     
     def all_people(self, database: Database) -> Iterable[Person]:
-        doc_refs = self.db.collection("people").list_documents()
-        return (self.from_dict(doc_ref.get().to_dict(), doc_ref.id, database) for doc_ref in doc_refs)
+        docs = self.db.collection("people").stream()
+        return (self.from_dict(doc.to_dict(), doc.id, database) for doc in docs)
+
+    def get_parents(self, id: int, database: Database) -> List[Person]:
+        # "children" is stored as a list of strings, which firestore indexes
+        # automatically for array-contains queries
+        query = self.db.collection("people").where("children", "array_contains", str(id))
+        metrics.count(db_queries=1)
+        parents = []
+        for doc in query.stream():
+            parent = self.from_dict(doc.to_dict(), doc.id, database)
+            self._store(parent)
+            parents.append(parent)
+        return parents
+
+    def migrate(self) -> int:
+        """Rewrite every document in the canonical format used by _prepare.
+
+        Documents written with integer ids in "children" are invisible to the
+        array-contains query in get_parents, so run this once on old data.
+        Returns the number of documents that were rewritten.
+        """
+        migrated = 0
+        for doc in self.db.collection("people").stream():
+            data = doc.to_dict() or {}
+            person = self.from_dict(data, doc.id, None)
+            prepared = self._prepare(person)
+            if any(data.get(key) != value for key, value in prepared.items()):
+                doc.reference.set(prepared, merge=True)
+                migrated += 1
+        return migrated
     
-    def _prepare(self, person: Person):
+    @staticmethod
+    def _prepare(person: Person):
         return {
             "partners": [str(x) for x in person.partners],
             "children": [str(x) for x in person.children]
         }
     
-    def from_dict(self, dictionary: dict, id: int, database: Database) -> Person:
+    @staticmethod
+    def from_dict(dictionary: dict, id: int, database: Database, cls=Person) -> Person:
         if dictionary is None:
             dictionary = {}
-        return Person(
+        return cls(
             id=int(id),
             database=database,
             partners=[int(partner) for partner in dictionary.get("partners", [])],
@@ -53,19 +266,116 @@ class FirestoreConnector:
 
 
 class FirestoreDatabase(Database):
-    def __init__(self, credentials_file="credentials.json"):
-        self.connector = FirestoreConnector(credentials_file)
+    def __init__(self, credentials_file="credentials.json", cache_size=4096, cache_ttl=None, watch=False, write_behind=0):
         super(FirestoreDatabase, self).__init__()
+        self.connector = FirestoreConnector(credentials_file, cache_size, cache_ttl, watch, write_behind)
+        self.connector.on_change = self._notify
     
     def get_person(self, id: int) -> Person:
         return self.connector.get_person(id, self)
     
+    def get_people(self, ids: Iterable[int]) -> List[Person]:
+        return self.connector.get_people(ids, self)
+
     def save_person(self, person: Person) -> None:
-        return self.connector.set_person(person.id, person)
+        self.connector.set_person(person.id, person)
+        self._notify(person)
+
+    def commit(self, changes: List[Change]) -> None:
+        for person in self.connector.commit(changes, self):
+            self._notify(person)
+
+    def flush(self) -> None:
+        self.connector.flush()
+
+    def all_people(self) -> Iterable[Person]:
+        return self.connector.all_people(self)
 
     def get_parents(self, id: int) -> List[Person]:
-        parents = []
-        for person in self.connector.all_people(self):
-            if id in person.children:
-                parents.append(person)
-        return parents
+        return self.connector.get_parents(id, self)
+
+
+class AsyncFirestoreDatabase(AsyncDatabase):
+    """Firestore through its native asyncio client, for scripts and tools.
+
+    AsyncDatabase has no listeners, so nothing learns about its writes: it
+    can't back MarriageCog, whose FamilyGraph, image cache and journal are
+    kept current by subscribing to a synchronous Database. The cog uses
+    ThreadedDatabase around FirestoreDatabase instead.
+    """
+
+    def __init__(self, credentials_file="credentials.json", cache_size=4096, cache_ttl=None):
+        try:
+            firebase_admin.get_app()
+        except ValueError:
+            firebase_admin.initialize_app(credentials.Certificate(credentials_file))
+
+        self.db = firestore_async.client()
+        self.cache = LRUCache(cache_size, cache_ttl)
+
+    def _from_dict(self, dictionary: dict, id: int) -> AsyncPerson:
+        person = FirestoreConnector.from_dict(dictionary, id, self, AsyncPerson)
+        self._store(person)
+        return person
+
+    def _store(self, person: AsyncPerson) -> None:
+        self.cache.set(person.id, (tuple(person.partners), tuple(person.children)))
+
+    def _cached(self, id: int) -> AsyncPerson:
+        cached = self.cache.get(id)
+        metrics.count(cache_hits=cached is not None, cache_misses=cached is None)
+        return None if cached is None else AsyncPerson(id, self, list(cached[0]), list(cached[1]))
+
+    async def get_person(self, id: int) -> AsyncPerson:
+        cached = self._cached(id)
+        if cached is not None:
+            return cached
+        doc = await self.db.collection("people").document(str(id)).get()
+        metrics.count(db_reads=1)
+        return self._from_dict(doc.to_dict(), id)
+
+    async def get_people(self, ids: Iterable[int]) -> List[AsyncPerson]:
+        ids = list(ids)
+        people = {}
+        for id in set(ids):
+            cached = self._cached(id)
+            if cached is not None:
+                people[id] = cached
+        missing = [id for id in set(ids) if id not in people]
+        if missing:
+            metrics.count(db_reads=len(missing))
+            doc_refs = [self.db.collection("people").document(str(id)) for id in missing]
+            async for doc in self.db.get_all(doc_refs):
+                person = self._from_dict(doc.to_dict(), doc.id)
+                people[person.id] = person
+        return [people[id] for id in ids]
+
+    async def save_person(self, person: AsyncPerson) -> None:
+        await self.db.collection("people").document(str(person.id)).set(FirestoreConnector._prepare(person))
+        self._store(person)
+
+    async def commit(self, changes: List[Change]) -> None:
+        batch = self.db.batch()
+        for id, data in delta_writes(coalesce({}, changes)):
+            batch.set(self.db.collection("people").document(str(id)), data, merge=True)
+        await batch.commit()
+        for id in dict.fromkeys(change.person.id for change in changes):
+            cached = self._cached(id)
+            if cached is not None:
+                self._store(apply(cached, changes))
+
+    async def get_parents(self, id: int) -> List[AsyncPerson]:
+        query = self.db.collection("people").where("children", "array_contains", str(id))
+        metrics.count(db_queries=1)
+        return [self._from_dict(doc.to_dict(), doc.id) async for doc in query.stream()]
+
+
+def main():
+    import sys
+
+    connector = FirestoreConnector(*sys.argv[1:2])
+    print(f"Migrated {connector.migrate()} documents")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,341 @@
+from threading import RLock
+from typing import Iterable, List, Mapping, NamedTuple, Optional, Tuple
+
+from database import Database, Person
+
+
+INVERSE = {"partner": "partner", "parent": "child", "child": "parent"}
+
+
+def kinship(path: List[Tuple[str, int]]) -> str:
+    """Describe a relationship path, e.g. "partner of the parent"."""
+    return " of the ".join(relation for relation, _ in reversed(path))
+
+
+class Detail(NamedTuple):
+    """Node budget for one tree; whatever does not fit is summarized."""
+    max_nodes: int = 80
+    max_partners: int = 12  # members shown per partner network
+    max_relatives: int = 12  # children or parents shown per person
+
+
+class Summary(NamedTuple):
+    """Stand-in node for `hidden` people attached to `anchor`."""
+    anchor: int
+    hidden: int
+    kind: str  # "partners", "children" or "parents"
+
+    @property
+    def label(self) -> str:
+        return f"+{self.hidden} {self.kind}"
+
+
+class FamilyGraph:
+    """Resident copy of every partner and parent/child edge.
+
+    The graph is loaded once from the database and then kept up to date by
+    subscribing to its changes, so family trees can be computed without any
+    storage round trips.
+    """
+
+    def __init__(self, database: Database):
+        self.database = database
+        self.partners = {}  # id -> set of partner ids
+        self.children = {}  # id -> set of child ids
+        self.parents = {}  # id -> set of parent ids
+        self.partnered = {}  # id -> set of ids listing id as a partner
+        self.rings = {}  # id -> set shared by every member of its partner network
+        self.loaded = False
+        self.lock = RLock()
+        self.buffered = None  # id -> person notified while a load streams in
+        database.subscribe(self.update)
+
+    def load(self, people: Iterable[Person] = None) -> None:
+        # People are read without holding the lock, which a slow stream would
+        # keep from every commit's update. Updates made meanwhile are newer
+        # than what was read, so they are buffered and applied last.
+        with self.lock:
+            self.buffered = {}
+        read = None
+        try:
+            read = list(self.database.all_people() if people is None else people)
+        finally:
+            with self.lock:
+                buffered, self.buffered = self.buffered, None
+                if read is not None:
+                    for person in read:
+                        self._set(person.id, person.partners, person.children)
+                    self.loaded = True
+                for person in buffered.values():
+                    self._set(person.id, person.partners, person.children)
+
+    def update(self, person: Person) -> None:
+        with self.lock:
+            if self.buffered is not None:
+                self.buffered[person.id] = person
+            else:
+                self._set(person.id, person.partners, person.children)
+
+    def _set(self, id: int, partners: Iterable[int], children: Iterable[int]) -> None:
+        children = set(children)
+        previous = self.children.get(id, set())
+        for child in previous - children:
+            self.parents[child].discard(id)
+        for child in children - previous:
+            self.parents.setdefault(child, set()).add(id)
+        self.children[id] = children
+
+        partners = set(partners)
+        previous = self.partners.get(id, set())
+        self.partners[id] = partners
+        for partner in partners - previous:
+            self.partnered.setdefault(partner, set()).add(id)
+            self._link(id, partner)
+        for partner in previous - partners:
+            self.partnered[partner].discard(id)
+            if id not in self.partners.get(partner, ()):
+                self._unlink(id, partner)
+
+    def _ring(self, id: int) -> set:
+        if id not in self.rings:
+            self.rings[id] = {id}
+        return self.rings[id]
+
+    def _link(self, a: int, b: int) -> None:
+        ring_a, ring_b = self._ring(a), self._ring(b)
+        if ring_a is ring_b:
+            return
+        if len(ring_a) < len(ring_b):
+            ring_a, ring_b = ring_b, ring_a
+        ring_a |= ring_b
+        for member in ring_b:
+            self.rings[member] = ring_a
+
+    def _unlink(self, a: int, b: int) -> None:
+        # The divorce only splits the network if b is no longer reachable from a
+        ring = self._ring(a)
+        reached = {a}
+        queue = [a]
+        for current in queue:
+            for member in self.partners.get(current, set()) | self.partnered.get(current, set()):
+                if member not in reached:
+                    if member == b:
+                        return
+                    reached.add(member)
+                    queue.append(member)
+        ring -= reached
+        for member in reached:
+            self.rings[member] = reached
+
+    def person(self, id: int) -> Person:
+        return Person(
+            id=id,
+            database=self.database,
+            partners=list(self.partners.get(id, ())),
+            children=list(self.children.get(id, ())),
+        )
+
+    def people(self) -> List[Person]:
+        """Everyone with partners or children, e.g. to write a snapshot."""
+        with self.lock:
+            return [self.person(id) for id in self.partners.keys() | self.children.keys()]
+
+    def partner_ring(self, id: int) -> Tuple[Mapping[int, List[int]], List[int]]:
+        with self.lock:
+            ring = [id] + [member for member in self.rings.get(id, ()) if member != id]
+            return {member: list(self.partners.get(member, ())) for member in ring}, ring
+
+    def limited_ring(self, id: int, limit: int) -> Tuple[Mapping[int, List[int]], List[int], int]:
+        """Like partner_ring, but only the `limit` members closest to `id`.
+
+        Also returns how many members were left out. Only the kept members
+        are visited, so the cost does not depend on the size of the ring.
+        """
+        with self.lock:
+            size = len(self.rings.get(id, ())) or 1
+            if size <= limit:
+                return (*self.partner_ring(id), 0)
+            ring = [id]
+            kept = {id}
+            for current in ring:
+                for partner in sorted(self.partners.get(current, set()) | self.partnered.get(current, set())):
+                    if len(ring) >= limit:
+                        break
+                    if partner not in kept:
+                        kept.add(partner)
+                        ring.append(partner)
+            map = {
+                member: [partner for partner in self.partners.get(member, ()) if partner in kept]
+                for member in ring
+            }
+            return map, ring, size - len(ring)
+
+    def generations(self, id: int, direction_children=True, steps=2, detail: Optional[Detail] = None):
+        """Walk `steps` generations away from the partner network of `id`.
+
+        Returns (generations, partner_map, descendance_map, people,
+        summaries), all in ids: generations is a list of [(isDirect, id)]
+        with every id at most once per generation, and both maps go from an
+        id to a list of ids. With a `detail` budget, people beyond it are
+        replaced by summary nodes with negative ids, described in summaries.
+        """
+        with self.lock:
+            walk = _Walk(self, detail)
+            partner_map, start = walk.start(id)
+            descendance_map = {}
+            kind = "children" if direction_children else "parents"
+            edges = self.children if direction_children else self.parents
+            generations = walk.walk(start, edges, kind, steps, partner_map, descendance_map)
+            return generations, partner_map, descendance_map, walk.people(generations, partner_map), walk.summaries
+
+    def both_generations(self, id: int, steps=2, detail: Optional[Detail] = None):
+        """Walk descendants and ancestors from one shared partner network.
+
+        Returns (generations_down, generations_up, partner_map,
+        descendance_map, people, summaries); descendance_map holds both
+        children and parents of the starting partner network.
+        """
+        with self.lock:
+            walk = _Walk(self, detail)
+            partner_map, start = walk.start(id)
+            children_map, parents_map = {}, {}
+            generations_down = walk.walk(start, self.children, "children", steps, partner_map, children_map)
+            generations_up = walk.walk(start, self.parents, "parents", steps, partner_map, parents_map)
+            descendance_map = dict(children_map)
+            for person, relatives in parents_map.items():
+                descendance_map[person] = descendance_map.get(person, []) + relatives
+            people = walk.people(generations_down + generations_up, partner_map)
+            return generations_down, generations_up, partner_map, descendance_map, people, walk.summaries
+
+    def relationship(self, a: int, b: int, max_depth=12, max_visited=100_000) -> Optional[List[Tuple[str, int]]]:
+        """Shortest chain of partner, parent and child links from a to b.
+
+        Returns [(relation, id)], where each id is the relation ("partner",
+        "parent" or "child") of the one before it, starting from a. Returns
+        None if no chain of at most max_depth links is found before
+        max_visited people have been looked at.
+        """
+        if a == b:
+            return []
+        with self.lock:
+            # id -> (neighbour towards a or b, relation, links from a or b)
+            forward, backward = {a: None}, {b: None}
+            frontiers = {True: [a], False: [b]}
+            depths = {True: 0, False: 0}
+            meets = []
+            while not meets and frontiers[True] and frontiers[False] and sum(depths.values()) < max_depth:
+                # Expanding the smaller side keeps the search from fanning out
+                side = len(frontiers[True]) <= len(frontiers[False])
+                seen, other = (forward, backward) if side else (backward, forward)
+                depths[side] += 1
+                frontier = []
+                for current in frontiers[side]:
+                    for relation, neighbour in self._neighbours(current):
+                        if neighbour in seen:
+                            continue
+                        # Checked per person, as one level of a big family can be huge
+                        if len(forward) + len(backward) >= max_visited:
+                            return None
+                        # Backward links are stored the way they are walked, from a to b
+                        seen[neighbour] = (current, relation if side else INVERSE[relation], depths[side])
+                        frontier.append(neighbour)
+                        if neighbour in other:
+                            meets.append(neighbour)
+                frontiers[side] = frontier
+            if not meets:
+                return None
+            # Every meet of the last level is a shortest path from this side,
+            # but the other side reached them at different depths
+            meet = min(meets, key=lambda id: sum(links[2] for links in (forward[id], backward[id]) if links))
+            path = []
+            current = meet
+            while forward[current] is not None:
+                previous, relation, _ = forward[current]
+                path.append((relation, current))
+                current = previous
+            path.reverse()
+            current = meet
+            while backward[current] is not None:
+                following, relation, _ = backward[current]
+                path.append((relation, following))
+                current = following
+            return path
+
+    def _neighbours(self, id: int) -> Iterable[Tuple[str, int]]:
+        for partner in self.partners.get(id, set()) | self.partnered.get(id, set()):
+            yield "partner", partner
+        for parent in self.parents.get(id, ()):
+            yield "parent", parent
+        for child in self.children.get(id, ()):
+            yield "child", child
+
+
+class _Walk:
+    """State of one generations walk: the node budget and its summaries."""
+
+    def __init__(self, graph: FamilyGraph, detail: Optional[Detail]):
+        self.graph = graph
+        self.detail = detail
+        self.seen = set()
+        self.summaries = {}
+
+    def people(self, generations, partner_map) -> List[int]:
+        people = dict.fromkeys(person for generation in generations for _, person in generation)
+        people.update(dict.fromkeys(partner for partners in partner_map.values() for partner in partners))
+        return list(people)
+
+    def summarize(self, anchor: int, hidden: int, kind: str) -> int:
+        id = -1 - len(self.summaries)
+        self.summaries[id] = Summary(anchor, hidden, kind)
+        return id
+
+    def ring(self, id: int, partner_map):
+        """Add the partner network of `id`, summarizing members over budget."""
+        if self.detail is None:
+            map, ring = self.graph.partner_ring(id)
+            hidden = 0
+        else:
+            limit = min(self.detail.max_partners, max(1, self.detail.max_nodes - len(self.seen)))
+            map, ring, hidden = self.graph.limited_ring(id, limit)
+        partner_map.update(map)
+        self.seen.update(ring)
+        if hidden:
+            summary = self.summarize(id, hidden, "partners")
+            partner_map[summary] = [id]
+            ring = ring + [summary]
+        return ring
+
+    def start(self, id: int):
+        partner_map = {}
+        return partner_map, [(True, person) for person in self.ring(id, partner_map)]
+
+    def walk(self, start, edges, kind, steps, partner_map, descendance_map):
+        generations = [start]
+        for _ in range(steps):
+            generation = {}  # id -> isDirect, in order of discovery
+            rings = set()
+            for _, person in generations[-1]:
+                if person < 0:
+                    continue
+                appended = sorted(edges.get(person, ()))
+                shown = appended
+                if self.detail is not None:
+                    room = max(0, self.detail.max_nodes - len(self.seen))
+                    shown = [relative for relative in appended if relative in self.seen]
+                    shown += [relative for relative in appended if relative not in self.seen][:min(room, self.detail.max_relatives)]
+                    shown.sort()
+                descendance_map[person] = shown
+                if len(shown) < len(appended):
+                    summary = self.summarize(person, len(appended) - len(shown), kind)
+                    descendance_map[person] = shown + [summary]
+                    generation[summary] = True
+                for relative in shown:
+                    generation[relative] = True
+                    if relative in rings:
+                        continue
+                    relative_ring = self.ring(relative, partner_map)
+                    rings.update(relative_ring)
+                    for member in relative_ring:
+                        generation.setdefault(member, False)
+            generations.append([(direct, person) for person, direct in generation.items()])
+        return generations
@@ -0,0 +1,162 @@
+from collections import Counter
+from itertools import count
+from math import cos, pi, sin
+from random import Random
+from threading import Lock
+from typing import Hashable, Iterable, Mapping, NamedTuple, Optional, Tuple
+
+from cache import LRUCache
+import metrics
+
+
+FULL_ITERATIONS = 50  # spring_layout's default
+MIN_ITERATIONS = 10
+SPREAD = 0.1  # distance from a relative at which new people start
+
+
+class Frame(NamedTuple):
+    """Where a layout sits among the stored positions."""
+    id: int
+    origin: Tuple[float, float]  # the root's position in frame id
+    merged: Mapping[int, Mapping[int, Tuple[float, float]]]  # other frame -> its people's positions
+
+
+def _neighbours(links: Iterable[Tuple[int, int]]) -> Mapping[int, list]:
+    neighbours = {}
+    for a, b in links:
+        neighbours.setdefault(a, []).append(b)
+        neighbours.setdefault(b, []).append(a)
+    return neighbours
+
+
+def _mean(positions) -> Tuple[float, float]:
+    positions = list(positions)
+    return sum(x for x, _ in positions) / len(positions), sum(y for _, y in positions) / len(positions)
+
+
+def _offset(id: int, x: float, y: float) -> Tuple[float, float]:
+    # The same small offset every time, so new people start in the same place
+    angle = Random(id).random() * 2 * pi
+    return x + SPREAD * cos(angle), y + SPREAD * sin(angle)
+
+
+class LayoutStore:
+    """Spring layout positions kept between renders of the same family.
+
+    Each family is drawn in a frame of its own, and every person's last
+    position is kept in their family's frame. A later layout of overlapping
+    people, from any root, starts where they were last drawn: people whose
+    links did not change stay in place and the solver only places the
+    others, in a few iterations. When a layout joins people from several
+    frames, as after a marriage between families, the other frames are
+    moved next to the root's and merged into it. A layout of exactly the
+    same people and links from the same root is not recomputed at all.
+    """
+
+    def __init__(self, maxsize=100_000, layouts=256):
+        self.positions = LRUCache(maxsize)  # id -> (frame, x, y, ids linked to last time)
+        self.layouts = LRUCache(layouts)  # (root, nodes, links) -> positions
+        self.frames = {}  # merged frame -> (frame it was merged into, x and y offset into it)
+        self.ids = count()
+        self.lock = Lock()
+
+    @staticmethod
+    def _key(root: int, nodes: Iterable[int], links: Iterable[Tuple[int, int]]) -> Hashable:
+        return root, frozenset(nodes), frozenset(links)
+
+    def get(self, root: int, nodes, links) -> Optional[Mapping]:
+        positions = self.layouts.get(self._key(root, nodes, links))
+        metrics.count(layout_reuses=positions is not None)
+        return None if positions is None else dict(positions)
+
+    def _resolve(self, frame: int) -> Tuple[int, float, float]:
+        """The frame a frame was merged into, and the offset of its positions there."""
+        start, x, y = frame, 0.0, 0.0
+        while frame in self.frames:
+            frame, dx, dy = self.frames[frame]
+            x, y = x + dx, y + dy
+        if start != frame:
+            self.frames[start] = (frame, x, y)
+        return frame, x, y
+
+    def _known(self, nodes) -> Mapping[int, tuple]:
+        """Map people drawn before to (frame, position, ids linked to)."""
+        known = {}
+        with self.lock:
+            # Summary nodes get new negative ids in every tree, so they aren't kept
+            for node in nodes:
+                stored = None if node < 0 else self.positions.get(node)
+                if stored is not None:
+                    frame, x, y, linked = stored
+                    frame, dx, dy = self._resolve(frame)
+                    known[node] = (frame, (x + dx, y + dy), linked)
+        return known
+
+    def seed(self, root: int, nodes: Iterable[int], links: Iterable[Tuple[int, int]]):
+        """Return (seed, fixed, iterations, frame) for a layout around root.
+
+        seed holds the known positions relative to root, with new people
+        placed next to a relative that has one. fixed lists the people who
+        should stay where they were drawn last time, which is everyone in
+        root's frame whose links are the same; only the others are laid
+        out. frame is passed on to save().
+        """
+        nodes = list(nodes)
+        neighbours = _neighbours(links)
+        known = self._known(nodes)
+        if not known:
+            return {root: (0.0, 0.0)}, [root], FULL_ITERATIONS, Frame(next(self.ids), (0.0, 0.0), {})
+        frames = Counter(frame for frame, _, _ in known.values())
+        main = known[root][0] if root in known else frames.most_common(1)[0][0]
+        drawn = {node: position for node, (frame, position, _) in known.items() if frame == main}
+        # root keeps its last position, or starts amid its relatives when it was never drawn
+        origin = drawn[root] if root in drawn else _mean(drawn.values())
+        seed = {node: (x - origin[0], y - origin[1]) for node, (x, y) in drawn.items()}
+        seed[root] = (0.0, 0.0)
+        present = {node for node in nodes if node >= 0}
+        fixed = [root]
+        for node in drawn:
+            linked = {neighbour for neighbour in neighbours.get(node, ()) if neighbour >= 0}
+            if node != root and linked == known[node][2] & present:
+                fixed.append(node)
+
+        # People from other frames keep their shape, moved next to the first
+        # of them reached from root's side
+        offsets = {}
+        queue = list(seed)
+        for node in queue:
+            for neighbour in neighbours.get(node, ()):
+                if neighbour in seed:
+                    continue
+                if neighbour in known:
+                    frame, (x, y), _ = known[neighbour]
+                    if frame not in offsets:
+                        start = _offset(neighbour, *seed[node])
+                        offsets[frame] = (start[0] - x, start[1] - y)
+                    seed[neighbour] = (x + offsets[frame][0], y + offsets[frame][1])
+                else:
+                    seed[neighbour] = _offset(neighbour, *seed[node])
+                queue.append(neighbour)
+        merged = {
+            frame: {node: position for node, (other, position, _) in known.items() if other == frame}
+            for frame in offsets
+        }
+        iterations = max(MIN_ITERATIONS, round(FULL_ITERATIONS * (1 - len(fixed) / len(nodes))))
+        return seed, fixed, iterations, Frame(main, origin, merged)
+
+    def save(self, root: int, nodes, links, positions: Mapping, frame: Frame) -> None:
+        neighbours = _neighbours(links)
+        with self.lock:
+            main, dx, dy = self._resolve(frame.id)
+            x0, y0 = frame.origin[0] + dx, frame.origin[1] + dy
+            placed = {node: (float(x) + x0, float(y) + y0) for node, (x, y) in positions.items() if node >= 0}
+            # Each merged frame moves by how far its people moved on average
+            for other, stored in frame.merged.items():
+                other, dx, dy = self._resolve(other)
+                if other != main:
+                    moves = [(placed[node][0] - x - dx, placed[node][1] - y - dy) for node, (x, y) in stored.items()]
+                    self.frames[other] = (main, *_mean(moves))
+            for node, (x, y) in placed.items():
+                linked = frozenset(neighbour for neighbour in neighbours.get(node, ()) if neighbour >= 0)
+                self.positions.set(node, (main, x, y, linked))
+        self.layouts.set(self._key(root, nodes, links), dict(positions))
@@ -0,0 +1,39 @@
+from typing import Iterable, List
+
+from database import Database, Person
+
+
+class MemoryDatabase(Database):
+    """Database kept in a dict, for tests, benchmarks and offline tools."""
+
+    def __init__(self, people: Iterable[Person] = ()):
+        super(MemoryDatabase, self).__init__()
+        self.people = {}
+        self.parents = {}  # id -> set of parent ids
+        self.load(people)
+
+    def load(self, people: Iterable[Person]) -> None:
+        for person in people:
+            self._set(person)
+
+    def _set(self, person: Person) -> None:
+        _, previous = self.people.get(person.id, ([], []))
+        for child in previous:
+            self.parents[child].discard(person.id)
+        for child in person.children:
+            self.parents.setdefault(child, set()).add(person.id)
+        self.people[person.id] = (list(person.partners), list(person.children))
+
+    def get_person(self, id: int) -> Person:
+        partners, children = self.people.get(id, ([], []))
+        return Person(id, self, list(partners), list(children))
+
+    def save_person(self, person: Person) -> None:
+        self._set(person)
+        self._notify(person)
+
+    def get_parents(self, id: int) -> List[Person]:
+        return self.get_people(sorted(self.parents.get(id, ())))
+
+    def all_people(self) -> Iterable[Person]:
+        return [self.get_person(id) for id in self.people]
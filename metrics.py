@@ -0,0 +1,172 @@
+"""Per-stage latency tracing for commands.
+
+A command runs inside `trace`, and every stage inside it in `span`. Spans
+feed histograms in the module-wide `registry` and, when the whole command is
+slow, a log line with the per-stage breakdown. The current trace is kept in
+a context variable, so spans in worker threads started with
+asyncio.to_thread are attributed to the right command.
+"""
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Thread
+from typing import Optional
+import asyncio
+import bisect
+import logging
+import time
+
+
+logger = logging.getLogger(__name__)
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+class Histogram:
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Registry:
+    def __init__(self):
+        self.histograms = {}  # (name, labels) -> Histogram
+        self.counters = Counter()  # (name, labels) -> value
+        self.collectors = {}  # prefix -> function returning {name: value}
+        self.lock = Lock()
+
+    def observe(self, name: str, value: float, **labels) -> None:
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            if key not in self.histograms:
+                self.histograms[key] = Histogram()
+            self.histograms[key].observe(value)
+
+    def inc(self, name: str, value: float = 1, **labels) -> None:
+        with self.lock:
+            self.counters[(name, tuple(sorted(labels.items())))] += value
+
+    def collect(self, prefix: str, function) -> None:
+        """Export the numbers function returns, e.g. a cache's stats, as gauges."""
+        with self.lock:
+            self.collectors[prefix] = function
+
+    def export(self) -> str:
+        """Render every metric in the Prometheus text format."""
+        def format_labels(labels, extra=()):
+            labels = list(labels) + list(extra)
+            if not labels:
+                return ""
+            return "{" + ",".join(f'{key}="{value}"' for key, value in labels) + "}"
+
+        lines = []
+        with self.lock:
+            collectors = list(self.collectors.items())
+        for prefix, function in collectors:
+            for name, value in function().items():
+                if isinstance(value, (int, float)):
+                    lines.append(f"{prefix}_{name} {value}")
+        with self.lock:
+            for (name, labels), value in sorted(self.counters.items()):
+                lines.append(f"{name}{format_labels(labels)} {value}")
+            for (name, labels), histogram in sorted(self.histograms.items(), key=lambda item: item[0]):
+                cumulative = 0
+                for bucket, count in zip(list(histogram.buckets) + ["+Inf"], histogram.counts):
+                    cumulative += count
+                    lines.append(f"{name}_bucket{format_labels(labels, [('le', bucket)])} {cumulative}")
+                lines.append(f"{name}_sum{format_labels(labels)} {histogram.sum}")
+                lines.append(f"{name}_count{format_labels(labels)} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+
+class Trace:
+    def __init__(self, name: str):
+        self.name = name
+        self.spans = []  # (stage, seconds)
+        self.counts = Counter()
+
+    def breakdown(self) -> str:
+        stages = ", ".join(f"{stage}={seconds:.3f}s" for stage, seconds in self.spans)
+        counts = ", ".join(f"{name}={value}" for name, value in sorted(self.counts.items()))
+        return f"{stages}; {counts}" if counts else stages
+
+
+_current: ContextVar[Optional[Trace]] = ContextVar("trace", default=None)
+
+
+@contextmanager
+def trace(name: str, slow: Optional[float] = None):
+    """Trace one command, logging its breakdown when it takes longer than `slow` seconds."""
+    current = Trace(name)
+    token = _current.set(current)
+    start = time.perf_counter()
+    try:
+        yield current
+    finally:
+        seconds = time.perf_counter() - start
+        _current.reset(token)
+        registry.observe("command_seconds", seconds, command=name)
+        if slow is not None and seconds > slow:
+            logger.warning("Slow %s took %.3fs: %s", name, seconds, current.breakdown())
+
+
+def record(stage: str, seconds: float) -> None:
+    """Record a stage that was timed elsewhere, e.g. in a worker process."""
+    registry.observe("stage_seconds", seconds, stage=stage)
+    current = _current.get()
+    if current is not None:
+        current.spans.append((stage, seconds))
+
+
+@contextmanager
+def span(stage: str, **counts):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(stage, time.perf_counter() - start)
+        count(**counts)
+
+
+def count(**counts) -> None:
+    current = _current.get()
+    for name, value in counts.items():
+        registry.inc(f"{name}_total", value)
+        if current is not None:
+            current.counts[name] += value
+
+
+def serve(port: int, host: str = "") -> ThreadingHTTPServer:
+    """Serve the registry in the Prometheus text format from a daemon thread."""
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = registry.export().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+async def log_periodically(interval: float) -> None:
+    while True:
+        await asyncio.sleep(interval)
+        logger.info("Metrics:\n%s", registry.export())
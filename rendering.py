@@ -0,0 +1,160 @@
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from io import BytesIO
+from typing import NamedTuple
+import asyncio
+import multiprocessing
+import os
+import resource
+import threading
+import time
+
+
+PAGE_SIZE = resource.getpagesize()
+
+
+class Budget(NamedTuple):
+    max_pixels: int = 16_000_000
+    max_side: int = 8192
+    max_bytes: int = 8 * 1024 * 1024  # discord's upload limit without boosts
+
+
+class RenderResult(NamedTuple):
+    data: bytes
+    extension: str
+    stats: dict
+
+    @property
+    def filename(self) -> str:
+        return f"tree.{self.extension}"
+
+
+def _save(image, format, **options) -> bytes:
+    with BytesIO() as output:
+        image.save(output, format, **options)
+        return output.getvalue()
+
+
+def encode(image, max_bytes=Budget().max_bytes):
+    """Encode an image as small as needed to fit in max_bytes.
+
+    Tries optimized PNG, then a 256 colour palette PNG, then WebP, and as a
+    last resort halves the resolution and starts over.
+    """
+    from PIL import Image
+
+    while True:
+        data = _save(image, "PNG", optimize=True)
+        if len(data) <= max_bytes:
+            return data, "png"
+        data = _save(image.quantize(256), "PNG", optimize=True)
+        if len(data) <= max_bytes:
+            return data, "png"
+        data = _save(image, "WEBP", quality=80, method=4)
+        if len(data) <= max_bytes or min(image.size) < 2:
+            return data, "webp"
+        image = image.resize((image.size[0] // 2, image.size[1] // 2), Image.LANCZOS)
+
+
+def _rss() -> int:
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * PAGE_SIZE
+    except OSError:
+        # Without /proc only the lifetime high-water mark is available, so
+        # growth is only seen when a render sets a new one
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class PeakMemory:
+    """Samples this process's RSS while a render runs, to find its peak.
+
+    Workers draw one tree at a time, so the growth over the RSS at the
+    start is the memory that render needed.
+    """
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.start = self.peak = _rss()
+        self.done = threading.Event()
+        self.thread = threading.Thread(target=self._sample, daemon=True)
+
+    def _sample(self) -> None:
+        while not self.done.wait(self.interval):
+            self.peak = max(self.peak, _rss())
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.done.set()
+        self.thread.join()
+        self.peak = max(self.peak, _rss())
+
+    @property
+    def growth(self) -> int:
+        return self.peak - self.start
+
+
+def _result(image, scale, budget, draw_seconds) -> RenderResult:
+    start = time.perf_counter()
+    data, extension = encode(image, budget.max_bytes)
+    return RenderResult(data, extension, {
+        "draw_seconds": draw_seconds,
+        "encode_seconds": time.perf_counter() - start,
+        "scale": scale,
+        "width": image.size[0],
+        "height": image.size[1],
+        "bytes": len(data),
+        "canvas_bytes": image.size[0] * image.size[1] * len(image.getbands()),
+    })
+
+
+def warm(scale=1024) -> None:
+    # Imported here so only workers load PIL, not the bot process
+    import resources
+
+    resources.warm(scale)
+
+
+def render_tree(positions, links, generation_mapping, avatar_map, username_map, downward=True, legend=True, budget=Budget()) -> RenderResult:
+    import visuals
+
+    width, height = visuals.calculate_canvas_units(positions)
+    scale = visuals.calculate_scale(width, height, budget.max_pixels, budget.max_side)
+    with PeakMemory() as memory:
+        start = time.perf_counter()
+        image = visuals.render(
+            positions, links, generation_mapping, avatar_map, username_map, downward, legend, scale
+        )
+        draw_seconds = time.perf_counter() - start
+        result = _result(image, scale, budget, draw_seconds)
+    result.stats["peak_rss_growth_bytes"] = memory.growth
+    return result
+
+
+class RenderPool:
+    """Worker processes that turn plain render inputs into encoded images.
+
+    Workers are spawned rather than forked, because the bot process runs
+    firestore and aiohttp threads that must not be copied mid-operation.
+    """
+
+    def __init__(self, workers=None, budget=Budget()):
+        self.workers = workers or os.cpu_count() or 1
+        self.executor = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context("spawn"))
+        self.budget = budget
+
+    async def run(self, function, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, partial(function, *args))
+
+    async def render_tree(self, *args) -> RenderResult:
+        return await self.run(render_tree, *args, self.budget)
+
+    async def warm(self) -> None:
+        """Start the workers and load the render libraries and fonts in them."""
+        await asyncio.gather(*(self.run(warm) for _ in range(self.workers)))
+
+    def close(self) -> None:
+        self.executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,41 @@
+"""Fonts, masks and colours shared by every render in a process.
+
+Each is loaded the first time it is asked for and kept for the life of the
+process, instead of being rebuilt on every render.
+"""
+from functools import lru_cache
+
+from PIL import Image, ImageDraw, ImageFont
+
+
+FONT_FILE = "impact.ttf"
+BACKGROUND_COLOR = (46, 52, 64)
+LINK_COLOR = (94, 129, 172)
+LABEL_COLOR = (59, 66, 82)
+TEXT_COLOR = (236, 239, 244)
+GENERATION_COLORS = (
+    (163, 190, 140),
+    (235, 203, 139),
+    (208, 135, 112),
+    (191, 97, 106),
+    (180, 142, 173),
+)
+
+
+@lru_cache(maxsize=32)
+def font(size: int) -> ImageFont.FreeTypeFont:
+    return ImageFont.truetype(FONT_FILE, size)
+
+
+@lru_cache(maxsize=8)
+def circle_mask(size: int) -> Image.Image:
+    mask = Image.new("L", (size, size))
+    ImageDraw.Draw(mask).ellipse([0, 0, size, size], 255)
+    return mask
+
+
+def warm(scale=1024) -> None:
+    """Load what a render at this scale needs, e.g. in a fresh worker."""
+    import visuals  # noqa: F401, pulls in networkx and numpy
+
+    font(int(0.0625 * scale))
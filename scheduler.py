@@ -0,0 +1,116 @@
+from collections import OrderedDict, deque
+from typing import Any, NamedTuple, Optional
+import asyncio
+import time
+
+import metrics
+
+
+class Busy(Exception):
+    """The queue, or this user's share of it, is full."""
+
+
+class Expired(Exception):
+    """The job could not finish before its deadline, so it was dropped."""
+
+
+class Ticket(NamedTuple):
+    user: int
+    guild: Optional[int]
+    deadline: float  # time.time() after which the result can't be delivered
+
+
+class Job(NamedTuple):
+    ticket: Ticket
+    started: asyncio.Future
+
+
+class Scheduler:
+    """Runs at most `concurrency` jobs at once and queues up to `queue_size`.
+
+    Queued jobs are started round-robin across guilds (or users, outside
+    guilds), so one busy server cannot starve the others, and each user may
+    only have `per_user` jobs queued. A job is dropped instead of started
+    when it would likely finish after its ticket's deadline, judging by how
+    long recent jobs took.
+    """
+
+    def __init__(self, concurrency=2, queue_size=32, per_user=2, estimate=5.0):
+        self.concurrency = concurrency
+        self.queue_size = queue_size
+        self.per_user = per_user
+        self.estimate = estimate  # moving average of job seconds
+        self.running = 0
+        self.queued = 0
+        self.queues = OrderedDict()  # guild or user -> deque of jobs
+        self.users = {}  # user -> queued jobs
+
+    def stats(self) -> dict:
+        return {"running": self.running, "queued": self.queued, "estimate": self.estimate}
+
+    async def run(self, ticket: Ticket, function, *args) -> Any:
+        if self.running < self.concurrency and not self.queued:
+            self.running += 1
+        else:
+            await self._wait(ticket)
+        try:
+            if time.time() + self.estimate > ticket.deadline:
+                metrics.count(jobs_expired=1)
+                raise Expired(f"Job for {ticket.user} would finish after its deadline")
+            start = time.perf_counter()
+            result = await function(*args)
+            self.estimate = 0.8 * self.estimate + 0.2 * (time.perf_counter() - start)
+            return result
+        finally:
+            self.running -= 1
+            self._start_next()
+
+    async def _wait(self, ticket: Ticket) -> None:
+        if self.queued >= self.queue_size or self.users.get(ticket.user, 0) >= self.per_user:
+            metrics.count(jobs_rejected=1)
+            raise Busy(f"{self.queued} jobs queued")
+        job = Job(ticket, asyncio.get_running_loop().create_future())
+        owner = ticket.user if ticket.guild is None else ticket.guild
+        self.queues.setdefault(owner, deque()).append(job)
+        self.queued += 1
+        self.users[ticket.user] = self.users.get(ticket.user, 0) + 1
+        with metrics.span("queued"):
+            try:
+                await job.started
+            except asyncio.CancelledError:
+                if job.started.cancelled():
+                    self._remove(owner, job)
+                else:
+                    # Cancelled after being handed a slot, so pass it on
+                    self.running -= 1
+                    self._start_next()
+                raise
+
+    def _remove(self, owner, job: Job) -> None:
+        queue = self.queues.get(owner, ())
+        if job not in queue:
+            return  # already skipped by _start_next
+        queue.remove(job)
+        if not queue:
+            del self.queues[owner]
+        self._dequeued(job)
+
+    def _dequeued(self, job: Job) -> None:
+        self.queued -= 1
+        self.users[job.ticket.user] -= 1
+        if not self.users[job.ticket.user]:
+            del self.users[job.ticket.user]
+
+    def _start_next(self) -> None:
+        while self.queues and self.running < self.concurrency:
+            # The first owner's oldest job goes next, and the owner moves to the back
+            owner, queue = next(iter(self.queues.items()))
+            job = queue.popleft()
+            if queue:
+                self.queues.move_to_end(owner)
+            else:
+                del self.queues[owner]
+            self._dequeued(job)
+            if not job.started.done():
+                self.running += 1
+                job.started.set_result(None)
@@ -0,0 +1,242 @@
+"""Compact binary snapshots of every person and edge.
+
+    python snapshot.py export people.snap --sqlite people.db
+    python snapshot.py export people.snap --credentials credentials.json
+    python snapshot.py info people.snap
+
+After a 64 byte header, a snapshot is five arrays of little-endian int64:
+
+    ids[count]
+    partner_offsets[count + 1], partners[partner_offsets[count]]
+    children_offsets[count + 1], children[children_offsets[count]]
+
+so person ids[i] has partners[partner_offsets[i]:partner_offsets[i + 1]],
+and likewise for children. Files are memory-mapped, so opening one costs
+nothing until people are read.
+
+Changes made after a snapshot was taken are caught up with a Journal: it
+appends every change the database notifies to a JSON lines file, and
+hydrate() replays the entries newer than the snapshot. A snapshot without
+its journal is stale, so checkpoint() rewrites the snapshot from a loaded
+graph and drops the journal entries it now covers.
+"""
+from array import array
+from threading import Lock
+from typing import Iterable, Iterator, List, Optional, Tuple
+import json
+import mmap
+import os
+import struct
+import sys
+import time
+
+from database import Database, Person
+
+
+MAGIC = b"PMBSNAP"
+VERSION = 1
+HEADER = struct.Struct("<7sBdqqq")  # magic, version, created_at, count, partner and children edges
+HEADER_SIZE = 64
+
+
+def write(path: str, people: Iterable[Person], created_at: Optional[float] = None) -> int:
+    """Write people to a snapshot at path and return how many were written.
+
+    created_at should be taken before reading the people, so a journal
+    replay also covers changes made while the snapshot was being written.
+    """
+    created_at = time.time() if created_at is None else created_at
+    ids = array("q")
+    partner_offsets, partners = array("q", [0]), array("q")
+    children_offsets, children = array("q", [0]), array("q")
+    for person in people:
+        ids.append(person.id)
+        partners.extend(person.partners)
+        partner_offsets.append(len(partners))
+        children.extend(person.children)
+        children_offsets.append(len(children))
+    if sys.byteorder != "little":
+        for values in (ids, partner_offsets, partners, children_offsets, children):
+            values.byteswap()
+
+    # Written next to the target and renamed, so readers never see half a file
+    temporary = f"{path}.tmp"
+    with open(temporary, "wb") as file:
+        header = HEADER.pack(MAGIC, VERSION, created_at, len(ids), len(partners), len(children))
+        file.write(header.ljust(HEADER_SIZE, b"\0"))
+        for values in (ids, partner_offsets, partners, children_offsets, children):
+            values.tofile(file)
+    os.replace(temporary, path)
+    return len(ids)
+
+
+class Snapshot:
+    """Read-only view of a snapshot file."""
+
+    def __init__(self, path: str):
+        with open(path, "rb") as file:
+            self.map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.created_at, count, partner_edges, children_edges = HEADER.unpack_from(self.map)
+        if magic != MAGIC or version != VERSION:
+            self.map.close()
+            raise ValueError(f"{path} is not a version {VERSION} snapshot")
+        if sys.byteorder != "little":
+            raise ValueError("Snapshots can only be mapped on little-endian machines")
+        values = memoryview(self.map)[HEADER_SIZE:].cast("q")
+        sizes = [count, count + 1, partner_edges, count + 1, children_edges]
+        arrays = []
+        start = 0
+        for size in sizes:
+            arrays.append(values[start:start + size])
+            start += size
+        self.ids, self.partner_offsets, self.partners, self.children_offsets, self.children = arrays
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self) -> None:
+        for view in (self.ids, self.partner_offsets, self.partners, self.children_offsets, self.children):
+            view.release()
+        self.map.close()
+
+    def edges(self, index: int) -> Tuple[List[int], List[int]]:
+        partners = self.partners[self.partner_offsets[index]:self.partner_offsets[index + 1]].tolist()
+        children = self.children[self.children_offsets[index]:self.children_offsets[index + 1]].tolist()
+        return partners, children
+
+    def people(self, database: Database = None) -> Iterator[Person]:
+        for index, id in enumerate(self.ids):
+            yield Person(id, database, *self.edges(index))
+
+
+class Journal:
+    """Database listener appending every notified person to a file."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = Lock()
+        self.file = open(path, "a", buffering=1)
+
+    def __call__(self, person: Person) -> None:
+        line = json.dumps({
+            "time": time.time(),
+            "id": person.id,
+            "partners": list(person.partners),
+            "children": list(person.children),
+        }) + "\n"
+        with self.lock:
+            self.file.write(line)
+
+    def compact(self, since: float) -> int:
+        """Drop the entries older than since and return how many are kept."""
+        with self.lock:
+            self.file.close()
+            with open(self.path) as file:
+                kept = [line for line in file if _newer(line, since)]
+            temporary = f"{self.path}.tmp"
+            with open(temporary, "w") as file:
+                file.writelines(kept)
+            os.replace(temporary, self.path)
+            self.file = open(self.path, "a", buffering=1)
+        return len(kept)
+
+    def close(self) -> None:
+        with self.lock:
+            self.file.close()
+
+
+def _newer(line: str, since: float) -> bool:
+    try:
+        return json.loads(line)["time"] >= since
+    except ValueError:
+        return False  # a line cut short by a crash
+
+
+def replay(path: str, since: float, database: Database = None) -> List[Person]:
+    """The latest journaled state of everyone who changed at or after since."""
+    people = {}
+    try:
+        with open(path) as file:
+            for line in file:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue  # a line cut short by a crash
+                if entry["time"] >= since:
+                    people[entry["id"]] = Person(entry["id"], database, entry["partners"], entry["children"])
+    except FileNotFoundError:
+        pass
+    return list(people.values())
+
+
+def hydrate(graph, path: str, journal: str = None) -> int:
+    """Load a FamilyGraph from a snapshot, then replay newer journal entries.
+
+    Returns how many people were replayed from the journal.
+    """
+    with Snapshot(path) as snapshot:
+        graph.load(snapshot.people(graph.database))
+        since = snapshot.created_at
+    changes = replay(journal, since, graph.database) if journal else []
+    for person in changes:
+        graph.update(person)
+    return len(changes)
+
+
+def checkpoint(graph, path: str, journal: Journal) -> int:
+    """Write a loaded graph to a snapshot and compact its journal.
+
+    Returns how many people were written. The journal keeps whatever was
+    logged after the snapshot was started, which replaying covers again.
+    """
+    created_at = time.time()
+    count = write(path, graph.people(), created_at)
+    journal.compact(created_at)
+    return count
+
+
+def main(argv=None):
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser(description=__doc__.splitlines()[0])
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    export = subparsers.add_parser("export", help="write every person in a database to a snapshot")
+    export.add_argument("path")
+    source = export.add_mutually_exclusive_group()
+    source.add_argument("--sqlite", help="read from this SQLite database")
+    source.add_argument("--credentials", default="credentials.json", help="read from firestore")
+    info = subparsers.add_parser("info", help="describe a snapshot")
+    info.add_argument("path")
+    args = parser.parse_args(argv)
+
+    if args.command == "export":
+        if args.sqlite:
+            from sqlite import SqliteDatabase
+
+            database = SqliteDatabase(args.sqlite)
+        else:
+            from firestore import FirestoreDatabase
+
+            database = FirestoreDatabase(args.credentials)
+        start = time.time()
+        count = write(args.path, database.all_people(), start)
+        print(f"Wrote {count} people to {args.path} in {time.time() - start:.1f}s")
+    else:
+        with Snapshot(args.path) as snapshot:
+            print(json.dumps({
+                "created_at": snapshot.created_at,
+                "people": len(snapshot),
+                "partner_edges": len(snapshot.partners),
+                "children_edges": len(snapshot.children),
+                "bytes": os.path.getsize(args.path),
+            }))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
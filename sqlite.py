@@ -0,0 +1,149 @@
+from threading import RLock
+from typing import Iterable, List, Mapping, Tuple
+import sqlite3
+
+from database import Change, Database, Person
+import metrics
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS people (id INTEGER PRIMARY KEY);
+CREATE TABLE IF NOT EXISTS partners (
+    person INTEGER NOT NULL,
+    partner INTEGER NOT NULL,
+    PRIMARY KEY (person, partner)
+);
+CREATE TABLE IF NOT EXISTS children (
+    parent INTEGER NOT NULL,
+    child INTEGER NOT NULL,
+    PRIMARY KEY (parent, child)
+);
+CREATE INDEX IF NOT EXISTS children_by_child ON children (child);
+"""
+
+# SQLite refuses statements with more host parameters than this
+VARIABLE_LIMIT = 900
+
+
+class SqliteDatabase(Database):
+    """Database stored in a local SQLite file.
+
+    Partner and parent/child edges live in their own tables. Partner rows
+    are stored from both sides and children are also indexed by child, so
+    every lookup is an index seek. Edge order is kept through rowid.
+    """
+
+    def __init__(self, path="people.db"):
+        super(SqliteDatabase, self).__init__()
+        self.connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.lock = RLock()
+        with self.lock:
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute("PRAGMA synchronous=NORMAL")
+            self.connection.executescript(SCHEMA)
+
+    def _query(self, sql: str, parameters=()) -> list:
+        metrics.count(db_queries=1)
+        with self.lock:
+            return self.connection.execute(sql, parameters).fetchall()
+
+    def _edges(self, table: str, source: str, target: str, ids: List[int]) -> Mapping[int, List[int]]:
+        edges = {id: [] for id in ids}
+        for start in range(0, len(ids), VARIABLE_LIMIT):
+            chunk = ids[start:start + VARIABLE_LIMIT]
+            rows = self._query(
+                f"SELECT {source}, {target} FROM {table} WHERE {source} IN ({','.join('?' * len(chunk))}) ORDER BY rowid",
+                chunk,
+            )
+            for a, b in rows:
+                edges[a].append(b)
+        return edges
+
+    def get_person(self, id: int) -> Person:
+        return self.get_people([id])[0]
+
+    def get_people(self, ids: Iterable[int]) -> List[Person]:
+        ids = list(ids)
+        distinct = list(set(ids))
+        partners = self._edges("partners", "person", "partner", distinct)
+        children = self._edges("children", "parent", "child", distinct)
+        return [Person(id, self, partners[id], children[id]) for id in ids]
+
+    def _save(self, person: Person) -> None:
+        cursor = self.connection.cursor()
+        cursor.execute("INSERT OR IGNORE INTO people VALUES (?)", (person.id,))
+        cursor.execute("DELETE FROM partners WHERE person = ?", (person.id,))
+        cursor.execute("DELETE FROM children WHERE parent = ?", (person.id,))
+        cursor.executemany(
+            "INSERT OR IGNORE INTO partners VALUES (?, ?)", [(person.id, x) for x in person.partners]
+        )
+        cursor.executemany(
+            "INSERT OR IGNORE INTO children VALUES (?, ?)", [(person.id, x) for x in person.children]
+        )
+
+    def save_person(self, person: Person) -> None:
+        self.load([person])
+        self._notify(person)
+
+    def load(self, people: Iterable[Person]) -> None:
+        """Save many people in one transaction, without notifying listeners."""
+        with self.lock:
+            self.connection.execute("BEGIN")
+            try:
+                for person in people:
+                    self._save(person)
+            except BaseException:
+                self.connection.execute("ROLLBACK")
+                raise
+            self.connection.execute("COMMIT")
+
+    def commit(self, changes: List[Change]) -> None:
+        tables = {"partners": ("partners", "person", "partner"), "children": ("children", "parent", "child")}
+        with self.lock:
+            self.connection.execute("BEGIN")
+            try:
+                for change in changes:
+                    table, source, target = tables[change.attribute]
+                    self.connection.execute("INSERT OR IGNORE INTO people VALUES (?)", (change.person.id,))
+                    self.connection.executemany(
+                        f"INSERT OR IGNORE INTO {table} ({source}, {target}) VALUES (?, ?)",
+                        [(change.person.id, x) for x in change.added],
+                    )
+                    self.connection.executemany(
+                        f"DELETE FROM {table} WHERE {source} = ? AND {target} = ?",
+                        [(change.person.id, x) for x in change.removed],
+                    )
+            except BaseException:
+                self.connection.execute("ROLLBACK")
+                raise
+            self.connection.execute("COMMIT")
+            # Listeners get the stored rows, not the callers' possibly stale copies
+            people = self.get_people(dict.fromkeys(change.person.id for change in changes))
+        for person in people:
+            self._notify(person)
+
+    def get_parents(self, id: int) -> List[Person]:
+        rows = self._query("SELECT parent FROM children WHERE child = ? ORDER BY rowid", (id,))
+        return self.get_people([parent for parent, in rows])
+
+    def all_people(self) -> Iterable[Person]:
+        ids = [id for id, in self._query(
+            "SELECT id FROM people UNION SELECT person FROM partners UNION SELECT parent FROM children"
+        )]
+        return self.get_people(ids)
+
+    def get_partner_ring(self, person: int) -> Tuple[Mapping[int, List[int]], List[int]]:
+        rows = self._query(
+            """
+            WITH RECURSIVE ring(id) AS (
+                SELECT ?
+                UNION
+                SELECT partners.partner FROM partners JOIN ring ON partners.person = ring.id
+            )
+            SELECT id FROM ring
+            """,
+            (person,),
+        )
+        ring = [person] + [id for id, in rows if id != person]
+        return self._edges("partners", "person", "partner", ring), ring
+
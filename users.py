@@ -0,0 +1,52 @@
+from typing import Dict, Iterable, NamedTuple, Optional
+import asyncio
+
+from cache import LRUCache, SingleFlight
+
+
+class UserInfo(NamedTuple):
+    name: str
+    avatar_url: Optional[str]
+
+
+class UserDirectory:
+    """Names and avatars of discord users, fetched at most once per TTL.
+
+    The gateway cache is checked first. The remaining users are fetched
+    concurrently, and concurrent requests for the same user share one call.
+    """
+
+    def __init__(self, bot, ttl=600, maxsize=4096):
+        self.bot = bot
+        self.cache = LRUCache(maxsize, ttl)
+        self.flights = SingleFlight()
+
+    @staticmethod
+    def _info(user) -> UserInfo:
+        return UserInfo(f"{user.name}#{user.discriminator}", user.avatar and user.avatar.url)
+
+    async def _fetch(self, id: int) -> UserInfo:
+        info = self._info(await self.bot.fetch_user(id))
+        self.cache.set(id, info)
+        return info
+
+    async def get(self, id: int) -> UserInfo:
+        return (await self.get_many([id]))[id]
+
+    async def get_many(self, ids: Iterable[int]) -> Dict[int, UserInfo]:
+        users = {}
+        missing = []
+        for id in set(ids):
+            info = self.cache.get(id)
+            if info is None:
+                user = self.bot.get_user(id)
+                if user is not None:
+                    info = self._info(user)
+                    self.cache.set(id, info)
+            if info is not None:
+                users[id] = info
+            else:
+                missing.append(id)
+        fetched = await asyncio.gather(*(self.flights.run(id, self._fetch, id) for id in missing))
+        users.update(zip(missing, fetched))
+        return users
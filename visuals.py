@@ -1,15 +1,11 @@
 from io import BytesIO
 from networkx import Graph, spring_layout
-from PIL import Image, ImageDraw, ImageFont
-from database import Person
-import copy
+from PIL import Image, ImageDraw
+import metrics
 import numpy as np
-import requests
+import resources
 
 
-def count_people(person, people):
-    return len([target for target in people if target.id == person.id])
-
 def get_name(i, downward=True):
     if not i:
         return "starting partner network"
@@ -17,100 +13,151 @@ def get_name(i, downward=True):
         return "grand" * (i-1) + ("child" if downward else "parent") + " or their peer"
 
 
-def remove_duplicates(people):
-    output = copy.copy(people)
-    for person in people:
-        while count_people(person, output) > 1:
-            for i, target in enumerate(output):
-                if target.id == person.id:
-                    del output[i]
-                    break
-    return people
+def calculate_generations(graph, person_id, direction_children=True, steps=2, detail=None):
+    if direction_children == "both":
+        return graph.both_generations(person_id, steps, detail)
+    return graph.generations(person_id, direction_children, steps, detail)
 
 
-def calculate_generations(person, direction_children=True, steps=2):
-    partners = person.get_partners()
-    generations = [[(True, x) for x in partners[1]]]  # (isDirect, person)
-    descendance_map = {}
-    partner_map_global, people = partners
-    for i in range(steps):
-        generations.append([])
-        for _, person in generations[-2]:
-            if direction_children:
-                appended = person.get_children()
-            else:
-                appended = person.get_parents()
-            descendance_map[person.id] = appended
-            people += appended
-            all_partners = []
-            for p in appended:
-                partner_map, partners = p.get_partners()
-                for partner in partners:
-                    all_partners.append(partner)
-                for partner, partners in partner_map.items():
-                    all_partners += partners
-                    partner_map_global[partner] = partners
-            all_partners = remove_duplicates(all_partners)
-            people += all_partners
-            for person in all_partners:
-                generations[-1].append((person in appended, person))
-    return generations, partner_map_global, descendance_map, remove_duplicates(people)
-
-
-def calculate_generation_mapping(generations):
-    people = {}
+def calculate_generation_mapping(generations, sign=1, people=None):
+    people = {} if people is None else people
     for i, generation in enumerate(generations):
         for isDirect, person in generation:
-            people[person.id] = people.get(person.id, []) + [(isDirect, i)]
+            people.setdefault(person, []).append((isDirect, sign * i))
     return people
 
 
+def calculate_both_generation_mapping(generations_down, generations_up):
+    """Generation mapping where ancestors get negative generation numbers."""
+    people = calculate_generation_mapping(generations_down)
+    return calculate_generation_mapping([[]] + generations_up[1:], -1, people)
+
+
 def calculate_graph_like_object(partner_map, descendance_map):
-    links = []
+    links = set()
     for person, descendants in descendance_map.items():
         for descendant in descendants:
-            links.append(tuple(sorted([person, descendant.id])))
+            links.add((person, descendant) if person < descendant else (descendant, person))
     for person, descendants in partner_map.items():
         for descendant in descendants:
-            links.append(tuple(sorted([person, descendant.id])))
-    return list(set(links))
+            links.add((person, descendant) if person < descendant else (descendant, person))
+    return list(links)
 
 
 def calculate_nx_graph(graph_like_object, nodes):
     graph = Graph()
     for node in nodes:
-        graph.add_node(node.id)
+        graph.add_node(node)
     for link in graph_like_object:
         graph.add_edge(*link)
     return graph
 
 
-def calculate_people_coordinates(graph, person):
-    positions = spring_layout(graph, dim=2, pos={person.id: (0, 0)}, fixed=[person.id])
+def calculate_people_coordinates(graph, person_id, seed=None, fixed=None, iterations=50):
+    pos = {person_id: (0, 0)} if seed is None else seed
+    fixed = [person_id] if fixed is None else fixed
+    if len(fixed) == len(graph):
+        return {person: np.array(position, dtype=float) for person, position in pos.items()}
+    positions = spring_layout(graph, dim=2, pos=pos, fixed=fixed, iterations=iterations)
     return positions
 
 
-def person_to_generations_and_coordinates(person, direction_children=True, steps=2):
-    generations, partner_map, descendance_map, nodes = calculate_generations(
-        person, direction_children, steps
-    )
-    generation_mapping = calculate_generation_mapping(generations)
-    graph_like_object = calculate_graph_like_object(partner_map, {} if direction_children is None else descendance_map)
-    nx_graph = calculate_nx_graph(graph_like_object, nodes)
-    positions = calculate_people_coordinates(nx_graph, person)
-    return generation_mapping, positions, graph_like_object
-
-
-def render(positions, links, generation_mapping, profile_picture_map, username_map, downward=True, display_legend=True):
-    generation_colors = [
-        (163, 190, 140),
-        (235, 203, 139),
-        (208, 135, 112),
-        (191, 97, 106),
-        (180, 142, 173),
-    ]
-    scale = 1024
-
+def calculate_layered_coordinates(links, generation_mapping, partner_map, person_id, downward=True):
+    """Deterministic Sugiyama-style layout: one row per generation.
+
+    Partners sharing a row are kept next to each other, and each partner
+    cluster is ordered by the average position of its relatives in the row
+    closer to the root, which keeps crossings low in a single outward sweep.
+    Negative generations (ancestors in "both" mode) go above the root.
+    """
+    horizontal, vertical = 0.5, 0.6
+    layers = {}
+    for person, gendata in generation_mapping.items():
+        layers.setdefault(min((generation for _, generation in gendata), key=abs), []).append(person)
+    layer_of = {person: layer for layer, people in layers.items() for person in people}
+
+    partners = {}
+    above = {}
+    for a, b in links:
+        if abs(layer_of[a]) == abs(layer_of[b]):
+            continue
+        if abs(layer_of[a]) > abs(layer_of[b]):
+            a, b = b, a
+        above.setdefault(b, []).append(a)
+    for person, people in partner_map.items():
+        for partner in people:
+            if layer_of.get(person) is not None and layer_of.get(person) == layer_of.get(partner):
+                partners.setdefault(person, set()).add(partner)
+                partners.setdefault(partner, set()).add(person)
+
+    order = {}
+    positions = {}
+    for layer in sorted(layers, key=lambda layer: (abs(layer), layer)):
+        seen = set()
+        clusters = []
+        for start in sorted(layers[layer]):
+            if start in seen:
+                continue
+            seen.add(start)
+            cluster = [start]
+            for current in cluster:
+                for partner in sorted(partners.get(current, ())):
+                    if partner not in seen:
+                        seen.add(partner)
+                        cluster.append(partner)
+            relatives = [order[relative] for member in cluster for relative in above.get(member, ())]
+            key = sum(relatives) / len(relatives) if relatives else float("inf")
+            clusters.append((key, start, cluster))
+        row = [person for _, _, cluster in sorted(clusters) for person in cluster]
+        for i, person in enumerate(row):
+            order[person] = i
+            y = layer * vertical * (-1 if downward is False else 1)
+            positions[person] = np.array([(i - (len(row) - 1) / 2) * horizontal, y])
+
+    center = positions[person_id].copy()
+    return {person: position - center for person, position in positions.items()}
+
+
+def person_to_generations_and_coordinates(family_graph, person_id, direction_children=True, steps=2, layout="layered", detail=None, layouts=None):
+    with metrics.span("traversal"):
+        if direction_children == "both":
+            generations_down, generations_up, partner_map, descendance_map, nodes, summaries = calculate_generations(
+                family_graph, person_id, direction_children, steps, detail
+            )
+            generation_mapping = calculate_both_generation_mapping(generations_down, generations_up)
+        else:
+            generations, partner_map, descendance_map, nodes, summaries = calculate_generations(
+                family_graph, person_id, direction_children, steps, detail
+            )
+            generation_mapping = calculate_generation_mapping(generations)
+        graph_like_object = calculate_graph_like_object(partner_map, {} if direction_children is None else descendance_map)
+    with metrics.span(f"layout_{layout}", nodes=len(generation_mapping), edges=len(graph_like_object)):
+        if layout == "layered":
+            positions = calculate_layered_coordinates(
+                graph_like_object, generation_mapping, partner_map, person_id, direction_children
+            )
+        elif layouts is None:
+            nx_graph = calculate_nx_graph(graph_like_object, nodes)
+            positions = calculate_people_coordinates(nx_graph, person_id)
+        else:
+            positions = layouts.get(person_id, nodes, graph_like_object)
+            if positions is None:
+                seed, fixed, iterations, frame = layouts.seed(person_id, nodes, graph_like_object)
+                nx_graph = calculate_nx_graph(graph_like_object, nodes)
+                positions = calculate_people_coordinates(nx_graph, person_id, seed, fixed, iterations)
+                layouts.save(person_id, nodes, graph_like_object, positions, frame)
+    return generation_mapping, positions, graph_like_object, summaries
+
+
+def calculate_path_coordinates(people, generations):
+    """Positions for a chain of people, left to right, parents above children."""
+    return {
+        person: np.array([(i - (len(people) - 1) / 2) * 0.6, generation * 0.5])
+        for i, (person, generation) in enumerate(zip(people, generations))
+    }
+
+
+def calculate_bounds(positions):
     bounds = [0, 0, 0, 0]  # min x; min y; max x; max y
     bounds[0] = min(position[0] for position in positions.values())
     bounds[1] = min(position[1] for position in positions.values())
@@ -124,12 +171,34 @@ def render(positions, links, generation_mapping, profile_picture_map, username_m
     bounds[1], bounds[3] = -max(abs(bounds[1]), abs(bounds[3])), max(
         abs(bounds[1]), abs(bounds[3])
     )
+    return bounds
+
+
+def calculate_canvas_units(positions):
+    """Size of the rendered canvas in layout units, one unit being `scale` pixels."""
+    bounds = calculate_bounds(positions)
+    return bounds[2] - bounds[0] + 2, bounds[3] - bounds[1] + 2
+
+
+def calculate_scale(width, height, max_pixels, max_side, max_scale=1024):
+    """Largest scale, up to max_scale, that fits a width x height unit canvas in the budget."""
+    scale = min(
+        max_scale,
+        (max_pixels / (width * height)) ** 0.5,
+        max_side / max(width, height),
+    )
+    return max(int(scale), 1)
 
+
+def render(positions, links, generation_mapping, avatar_map, username_map, downward=True, display_legend=True, scale=1024):
+    generation_colors = resources.GENERATION_COLORS
+
+    bounds = calculate_bounds(positions)
     size = ((bounds[2] - bounds[0] + 2) * scale, (bounds[3] - bounds[1] + 2) * scale)
     size = [int(x) for x in size]
     offset = [bounds[0], bounds[1]]
 
-    image = Image.new("RGB", size, (46, 52, 64))
+    image = Image.new("RGB", size, resources.BACKGROUND_COLOR)
     draw = ImageDraw.Draw(image)
 
     thickness = max(int(0.025 * scale), 1)
@@ -145,12 +214,10 @@ def render(positions, links, generation_mapping, profile_picture_map, username_m
                 * scale
             )
         )
-        draw.line(coords, (94, 129, 172), thickness)
+        draw.line(coords, resources.LINK_COLOR, thickness)
 
     pfp_size_in_pixels = [int(0.2 * scale), int(0.2 * scale)]
-    mask = Image.new("L", pfp_size_in_pixels)
-    ImageDraw.Draw(mask).ellipse([0, 0] + pfp_size_in_pixels, 255)
-    font = ImageFont.truetype("impact.ttf", int(0.0625 * scale))
+    font = resources.font(int(0.0625 * scale))
     for user_id, position in positions.items():
         # We have to draw the genreration pie chart first
         if downward is not None:
@@ -179,13 +246,12 @@ def render(positions, links, generation_mapping, profile_picture_map, username_m
                     fill=generation_colors[slice[1] % len(generation_colors)],
                 )
 
-        url = profile_picture_map[user_id]
-        if url:
-            pfp = (
-                Image.open(BytesIO(requests.get(url).content))
-                .convert("RGB")
-                .resize(pfp_size_in_pixels)
-            )
+        avatar = avatar_map[user_id]
+        if avatar:
+            # Avatars arrive already resized and circle-masked, see avatars.py
+            pfp = Image.open(BytesIO(avatar))
+            if list(pfp.size) != pfp_size_in_pixels:
+                pfp = pfp.resize(pfp_size_in_pixels)
             image.paste(
                 pfp,
                 [
@@ -194,7 +260,7 @@ def render(positions, links, generation_mapping, profile_picture_map, username_m
                         (position - [0.1, 0.1] - offset) * scale + [scale, scale]
                     )
                 ],
-                mask,
+                pfp,
             )
 
         padding = int(0.0625 / 2 * scale)
@@ -212,8 +278,8 @@ def render(positions, links, generation_mapping, profile_picture_map, username_m
             text_coords[0] + text_size[0] + padding,
             text_coords[1] + text_size[1] + padding,
         ]
-        draw.rounded_rectangle(box, padding, (59, 66, 82))
-        draw.text(text_coords, text, (236, 239, 244), font=font)
+        draw.rounded_rectangle(box, padding, resources.LABEL_COLOR)
+        draw.text(text_coords, text, resources.TEXT_COLOR, font=font)
 
     if not display_legend:
         return image
@@ -222,51 +288,23 @@ def render(positions, links, generation_mapping, profile_picture_map, username_m
     return image
 
 def draw_legend(draw, generation_mapping, generation_colors, scale, downward, initial_position=[0, 0]):
-    font = ImageFont.truetype("impact.ttf", int(0.0625 * scale))
-    n_generations = max(max([generation[1] for generation in person]) for person in generation_mapping.values())
-    if not n_generations:
+    font = resources.font(int(0.0625 * scale))
+    generations = [generation[1] for person in generation_mapping.values() for generation in person]
+    first, last = min(generations), max(generations)
+    if first == last == 0:
         return
-    for i in range(n_generations+1):
+    for row, i in enumerate(range(first, last+1)):
         draw.ellipse(
             [
                 initial_position[0] + int(scale*0.125),
-                initial_position[1] + int(scale*(i+1)*0.125),
+                initial_position[1] + int(scale*(row+1)*0.125),
                 initial_position[0] + int(scale*0.1875),
-                initial_position[1] + int(scale*(i+1.5)*0.125),
+                initial_position[1] + int(scale*(row+1.5)*0.125),
             ],
             fill=generation_colors[i%len(generation_colors)]
         )
         draw.text(
-            [initial_position[0] + int(scale*0.25), initial_position[1] + int(scale*(i+1)*0.125)],
-            text=get_name(i, downward=downward),
+            [initial_position[0] + int(scale*0.25), initial_position[1] + int(scale*(row+1)*0.125)],
+            text=get_name(abs(i), downward=i > 0 if downward == "both" else downward),
             font=font
         )
-
-def merge_images(image_down, image_up, generations_down, generations_up):
-    generation_colors = [
-        (163, 190, 140),
-        (235, 203, 139),
-        (208, 135, 112),
-        (191, 97, 106),
-        (180, 142, 173),
-    ]
-    scale = 1024
-
-    image = Image.new("RGB", (image_down.size[0] + image_up.size[0], max(image_down.size[1], image_up.size[1])), (46, 52, 64))
-    image.paste(image_down, [0, (image.size[1] - image_down.size[1]) // 2])
-    image.paste(image_up, [image_down.size[0], (image.size[1] - image_up.size[1]) // 2])
-    generations = {}
-    for person, generations_p in generations_down.items():
-        generations[person] = list(set(generations.get(person, []) + generations_p))
-    for person, generations_p in generations_up.items():
-        generations[person] = list(set(generations.get(person, []) + generations_p))
-    
-    draw = ImageDraw.Draw(image)
-    font = ImageFont.truetype("impact.ttf", int(0.125 * scale))
-
-    draw.text([int(scale*0.125), int(scale*0.125)], "Descendants", font=font)
-    draw.text([int(scale*0.125) + image_down.size[0], int(scale*0.125)], "Ancestors", font=font)
-    draw_legend(draw, generations_down, generation_colors, scale, True, [0, int(scale*0.15)])
-    draw_legend(draw, generations_up, generation_colors, scale, False, [image_down.size[0], int(scale*0.15)])
-
-    return image, generations
\ No newline at end of file